@@ -0,0 +1,51 @@
+import numpy as np
+
+
+def moving_average(data, days=7):
+    # Use 1d convolution for moving average, as explained in https://stackoverflow.com/a/22621523.
+    return np.convolve(data, np.ones(days) / days, mode="valid")
+
+
+def _finite(array):
+    return np.where(np.isfinite(array), array, np.nan)
+
+
+# the difference of the cumulative numbers over the last `days` days, `offset` days ago
+def _window(cumulative, days, offset=0):
+    end = cumulative.shape[1] - 1 - offset
+    if end - days < 0:
+        return np.full(cumulative.shape[0], np.nan)
+    return cumulative[:, end] - cumulative[:, end - days]
+
+
+def compute(store, populations):
+    """Computes the trend metrics of all places in the time series store at once.
+
+    `populations` maps the keys of the store to the number of inhabitants. Returns {key: {metric: value}}, values
+    that cannot be computed, e.g. the growth of a country without cases in the week before, are NaN.
+    """
+    metrics = {}
+    for name in ("cases", "deaths"):
+        series = store.series(name)
+        if series is None:
+            continue
+        keys, _, cumulative = series
+        cumulative = np.asarray(cumulative)
+        this_week, last_week = _window(cumulative, 7), _window(cumulative, 7, offset=7)
+        population = np.array([populations.get(key) or np.nan for key in keys], dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            columns = {
+                name + "Avg7": np.round(this_week / 7, 1),
+                name + "Avg7PerMillion": np.round(this_week / 7 / population * 1e6, 2),
+                # the change of new cases compared to the week before, in percent
+                name + "Growth": np.round(_finite((this_week / last_week - 1) * 100), 1),
+            }
+            if name == "cases":
+                # days until the total number of cases doubles at the growth rate of the last week
+                ratio = cumulative[:, -1] / (cumulative[:, -1] - this_week)
+                doubling = np.where(ratio > 1, 7 * np.log(2) / np.log(ratio), np.nan)
+                columns["casesDoublingTime"] = np.round(_finite(doubling), 1)
+        for column, values in columns.items():
+            for key, value in zip(keys, values.tolist()):
+                metrics.setdefault(key, {})[column] = value
+    return metrics
@@ -0,0 +1,205 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+import threading
+
+import aiohttp
+
+from statistics_api import BASE_URL, CONDITIONAL_PATHS
+import transport
+import wikidata
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncHttpClient:
+    """The aiohttp counterpart of transport.HttpClient, sharing the timeouts, circuit breakers and validators of
+    `client`. The session is created on the first request, in the event loop that runs the requests.
+    """
+
+    def __init__(self, client=None, pool_size=100):
+        self.client = client or transport.client
+        self.pool_size = pool_size
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            timeout = self.client.timeout
+            connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+            self._session = aiohttp.ClientSession(
+                headers={"User-Agent": transport.user_agent},
+                timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+                connector=aiohttp.TCPConnector(limit=self.pool_size))
+        return self._session
+
+    # Returns the parsed JSON body or None if the request failed.
+    async def get_json(self, url, params=None, conditional=False):
+        key = (url, tuple(sorted(params.items())) if params else ())
+        validator, headers = self.client.conditional_headers(key) if conditional else (None, {})
+        breaker = self.client.breaker(url)
+        if not breaker.allow():
+            return None
+        # aiohttp only accepts strings as query parameters
+        query = {name: str(value) for name, value in params.items()} if params else None
+        try:
+            async with self._get_session().get(url, params=query, headers=headers) as response:
+                status, response_headers = response.status, response.headers
+                body = await response.json(content_type=None) if status == 200 else None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+            breaker.failure()
+            logger.warning("Request to {} failed: {}".format(url, ex))
+            return None
+        if status >= 500 or status == 429:
+            breaker.failure()
+        else:
+            breaker.success()
+        return self.client.response_data(key, validator, status, response_headers, lambda: body, conditional)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def _coroutine(name):
+    async def method(self, *args, **kwargs):
+        return await self._call(name, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = "The coroutine of CovidApi.{}.".format(name)
+    return method
+
+
+class AsyncCovidApi:
+    """Coroutines with the methods and results of a CovidApi, for handlers running in an asyncio event loop.
+
+    A method first runs on the cached responses of `api` (see `CovidApi.cached`). The endpoints that were
+    missing are fetched concurrently with aiohttp and put into the cache of `api`, then the method runs again.
+    So both share the cache, the last good responses and the parsing, and no call ever blocks the loop.
+    Concurrent requests of the same endpoint share one upstream call.
+    """
+
+    def __init__(self, api, client=None):
+        self.api = api
+        self.client = client or AsyncHttpClient(api.client)
+        # key -> task of the running request
+        self._flights = {}
+
+    countries = property(lambda self: self.api.countries)
+    name_map = property(lambda self: self.api.name_map)
+    commands = property(lambda self: self.api.commands)
+    region_states = property(lambda self: self.api.region_states)
+    us_states = property(lambda self: self.api.us_states)
+    de_states = property(lambda self: self.api.de_states)
+    index = property(lambda self: self.api.index)
+
+    def metrics(self, country=None):
+        return self.api.metrics(country)
+
+    def data_as_of(self):
+        return self.api.data_as_of()
+
+    async def _call(self, name, *args, **kwargs):
+        method = getattr(self.api, name)
+        loaded = set()
+        while True:
+            result, missed = self.api.cached(method, *args, **kwargs)
+            # endpoints that failed already are answered with the last good response
+            missed = {self.api._key(path, params): (path, params) for path, params in missed}
+            missed = {key: endpoint for key, endpoint in missed.items() if key not in loaded}
+            if not missed:
+                return result
+            # the bulk endpoints first, once they are loaded the endpoints of single countries are rarely needed
+            bulk = {key: (path, params) for key, (path, params) in missed.items() if path in CONDITIONAL_PATHS}
+            missed = bulk or missed
+            loaded.update(missed)
+            await asyncio.gather(*(self._shared(key, partial(self._fetch, path, params))
+                                   for key, (path, params) in missed.items()))
+
+    # runs the coroutine function once for all concurrent callers with the same key
+    async def _shared(self, key, function):
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(function())
+            self._flights[key] = task
+            task.add_done_callback(lambda _: self._flights.pop(key, None))
+        # a cancelled caller must not cancel the request of the others
+        return await asyncio.shield(task)
+
+    async def _fetch(self, path, params):
+        data = await self.client.get_json(BASE_URL + path, params=params, conditional=path in CONDITIONAL_PATHS)
+        return self.api.put(path, params, data)
+
+    cases_world = _coroutine("cases_world")
+    cases_country_list = _coroutine("cases_country_list")
+    country_ranking = _coroutine("country_ranking")
+    cases_country = _coroutine("cases_country")
+    cases_region = _coroutine("cases_region")
+    cases_us_state = _coroutine("cases_us_state")
+    cases_de_state = _coroutine("cases_de_state")
+    find_region = _coroutine("find_region")
+    timeseries = _coroutine("timeseries")
+    vaccinations_world = _coroutine("vaccinations_world")
+    vaccinations_country = _coroutine("vaccinations_country")
+    vaccinations_country_list = _coroutine("vaccinations_country_list")
+    vaccinations_series = _coroutine("vaccinations_series")
+
+    # The coroutine of wikidata.cases_country_map, which runs the query with aiohttp if the maps are outdated. The
+    # functions of wikidata take its lock and read files, so they run in the default executor of the loop.
+    async def cases_country_map(self, country_code, timestamp=True):
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, wikidata.query_due):
+            await self._shared("wikidata", self._query_maps)
+        return await loop.run_in_executor(None, wikidata.cases_country_map, country_code, timestamp)
+
+    # query_due marked the query as running, so the result is always stored, even if it failed
+    async def _query_maps(self):
+        maps = None
+        try:
+            results = await self.client.get_json(wikidata.SPARQL_URL,
+                                                 params={"query": wikidata.QUERY, "format": "json"})
+            maps = wikidata.parse_maps(results) if results else None
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, wikidata.set_maps, maps)
+
+    async def close(self):
+        await self.client.close()
+
+
+class EventLoopThread:
+    """Runs an asyncio event loop in a daemon thread.
+
+    Handlers of the dispatcher hand their coroutines to the loop with `submit` and return right away, so waiting
+    for the API does not take up a dispatcher thread. Blocking calls, e.g. sending the answer with the Bot, are
+    run by `blocking` in a small thread pool.
+    """
+
+    def __init__(self, workers=8):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="event-loop")
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.loop.run_forever, name="event-loop", daemon=True)
+        self._thread.start()
+
+    def submit(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        future.add_done_callback(self._log_exception)
+        return future
+
+    @staticmethod
+    def _log_exception(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Coroutine failed", exc_info=future.exception())
+
+    async def blocking(self, function, *args, **kwargs):
+        return await self.loop.run_in_executor(self.executor, partial(function, *args, **kwargs))
+
+    # runs the coroutine, e.g. to close sessions, and stops the loop
+    def stop(self, coroutine=None):
+        if coroutine is not None:
+            asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.executor.shutdown()
@@ -0,0 +1,236 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from unittest.mock import MagicMock
+
+from telegram import Message, MessageEntity, Update, User
+from telegram.ext import CommandHandler, PicklePersistence
+
+from handlers import CountryCommandHandler
+
+from persistence import SqlitePersistence, WriteBehindPersistence
+from statistics_api import BASE_URL, CovidApi
+
+
+def _measure(function, inputs, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in inputs:
+            function(item)
+        best = min(best, time.perf_counter() - start)
+    return best / len(inputs)
+
+
+UNITS = {"µs": 1e6, "ms": 1e3}
+
+
+def _report(name, seconds, unit="µs"):
+    print("{:<24} {:>10.2f} {}".format(name, seconds * UNITS[unit], unit))
+
+
+# the linear scan that handle_inlinequery used before the prefix index
+def _scan_places(api, query_string, limit=3):
+    results = []
+    for name in api.name_map.keys():
+        if name.startswith(query_string):
+            results.append((name, "country"))
+        if len(results) >= limit:
+            return results
+    for state in api.us_states:
+        if state.lower().startswith(query_string):
+            results.append((state.lower(), "us_state"))
+        if len(results) >= limit:
+            return results
+    for state in api.de_states:
+        if state.lower().startswith(query_string):
+            results.append((state.lower(), "de_state"))
+        if len(results) >= limit:
+            return results
+    return results
+
+
+def bench_inline(args):
+    api = CovidApi()
+    names = list(api.name_map) + [state.lower() for state in api.us_states + api.de_states]
+    # every prefix a user could type, including some that match nothing
+    queries = sorted({name[:n] for name in names for n in range(1, 6)} | {"xyz", "zzzz", "qq"})
+    print("{} places, {} queries".format(len(names), len(queries)))
+    _report("linear scan", _measure(lambda q: _scan_places(api, q), queries, args.repeat))
+    _report("prefix index", _measure(lambda q: api.index.search(q, k=3), queries, args.repeat))
+
+
+# Fills the persistence through its update methods, as the dispatcher does, so every persistence stores the
+# users. A PicklePersistence would write the whole file for every user, so it only writes it once at the end.
+def _fill_persistence(persistence, users):
+    persistence.get_user_data()
+    persistence.get_chat_data()
+    persistence.get_bot_data()
+    on_flush = getattr(persistence, 'on_flush', None)
+    if on_flush is not None:
+        persistence.on_flush = True
+    for user_id in range(users):
+        persistence.update_user_data(user_id, {'first_acc': 0.0, 'last_acc': 0.0, 'count': 1})
+        persistence.update_chat_data(user_id, {'country': "KE", 'order': "cases"})
+    persistence.bot_data['subscribers'] = {chat_id: (None, None) for chat_id in range(0, users, 2)}
+    persistence.bot_data['subscribers_version'] = 1
+    persistence.update_bot_data(persistence.bot_data)
+    persistence.flush()
+    if on_flush is not None:
+        persistence.on_flush = on_flush
+
+
+# what the dispatcher and handler_decorator do with the persistence after every handled update
+def _persist_update(persistence, user_id):
+    persistence.update_user_data(user_id, {'first_acc': 0.0, 'last_acc': time.time(), 'count': 2})
+    persistence.update_chat_data(user_id, {'country': "KE", 'order': "cases"})
+    persistence.update_bot_data(persistence.bot_data)
+    if not getattr(persistence, 'write_behind', False):
+        persistence.flush()
+
+
+def bench_persistence(args):
+    print("per-update latency by number of users in the database")
+    for users in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            for name, persistence in [
+                ("pickle", PicklePersistence(os.path.join(directory, "pickle.pkl"))),
+                ("write-behind", WriteBehindPersistence(os.path.join(directory, "write_behind.pkl"))),
+                ("sqlite", SqlitePersistence(os.path.join(directory, "database.sqlite"))),
+            ]:
+                _fill_persistence(persistence, users)
+                user_ids = range(0, users, max(1, users // args.updates))
+                seconds = _measure(lambda user_id: _persist_update(persistence, user_id), user_ids, 1)
+                _report("{} ({} users)".format(name, users), seconds)
+
+
+# the handlers bot.main registered for the country commands before CountryCommandHandler
+def _country_command_handlers(api):
+    handlers = []
+    for iso, country in api.countries.items():
+        callback = lambda update, context, code=iso: None
+        handlers.append(CommandHandler(iso, callback))
+        if country['iso3']:
+            handlers.append(CommandHandler(country['iso3'], callback))
+        handlers.append(CommandHandler(re.sub(r"[^a-z]", "_", country['name'].lower()), callback))
+    return handlers
+
+
+def _message_update(bot, text):
+    entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text.split()[0]))] if text.startswith("/") else []
+    message = Message(1, None, None, from_user=User(1, "user", False), text=text, entities=entities, bot=bot)
+    return Update(1, message=message)
+
+
+# what the dispatcher does for every update: test the handlers in order until one matches
+def _match(handlers, update):
+    for handler in handlers:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            return handler
+    return None
+
+
+def bench_dispatch(args):
+    api = CovidApi()
+    bot = MagicMock(username="coronaviruskenyabot")
+    commands = list(api.commands)
+    texts = ["/" + command for command in commands] + ["kenya", "/help", "/unknown"] * (len(commands) // 3)
+    updates = [_message_update(bot, text) for text in texts]
+    before = _country_command_handlers(api)
+    after = [CountryCommandHandler(lambda command: api.commands.get(command), lambda update, context, code: None)]
+    print("{} handlers before, {} updates".format(len(before), len(updates)))
+    _report("command handlers", _measure(lambda update: _match(before, update), updates, args.repeat))
+    _report("country handler", _measure(lambda update: _match(after, update), updates, args.repeat))
+
+
+# milliseconds `import bot` may take before the startup benchmark fails
+STARTUP_BUDGET = 1000
+
+
+class _FixtureClient:
+    """Answers the metadata endpoints with generated payloads of about the size of the real ones, so the startup
+    benchmark runs without network. Only parsing the payloads and building the metadata is measured."""
+
+    def __init__(self, countries=230, states=60, provinces=16):
+        codes = [chr(ord("A") + i // 26) + chr(ord("A") + i % 26) for i in range(countries)]
+        self.payloads = {
+            "countries": [{"country": "Country {}".format(code), "cases": 1000, "deaths": 10, "recovered": 900,
+                           "countryInfo": {"_id": i, "iso2": code, "iso3": code + "X", "lat": 0, "long": 0,
+                                           "flag": "https://disease.sh/assets/img/flags/{}.png".format(code.lower())}}
+                          for i, code in enumerate(codes)],
+            "states": [{"state": "State {}".format(i), "cases": 100, "deaths": 1, "active": 10} for i in range(states)],
+            "gov/de": [{"province": "Province {}".format(i), "cases": 100, "deaths": 1, "recovered": 90}
+                       for i in range(provinces)],
+        }
+
+    def get_json(self, url, params=None, conditional=False):
+        return self.payloads.get(url[len(BASE_URL):])
+
+
+# seconds until `import bot` returns in a new interpreter, i.e. until main could start
+def _import_time():
+    code = "import time; start = time.perf_counter(); import bot; print(time.perf_counter() - start)"
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return float(output.split()[-1])
+
+
+# (module, self seconds, cumulative seconds) of every module imported by bot.py, from `python -X importtime`
+def _import_profile():
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import bot"], check=True,
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+    profile = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, module = line[len("import time:"):].split("|")
+        profile.append((module.strip(), int(own) / 1e6, int(cumulative) / 1e6))
+    return profile
+
+
+def bench_startup(args):
+    if args.profile_startup:
+        # the modules whose own code takes longest to import, their cumulative times include their imports
+        print("{:<40} {:>10} {:>10}".format("module", "self", "cumulative"))
+        for module, own, cumulative in sorted(_import_profile(), key=lambda item: item[1], reverse=True)[:args.top]:
+            print("{:<40} {:>7.2f} ms {:>7.2f} ms".format(module, own * 1e3, cumulative * 1e3))
+        return
+    seconds = min(_import_time() for _ in range(args.repeat))
+    _report("import bot", seconds, "ms")
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot_file = os.path.join(directory, "metadata.json")
+        client = _FixtureClient()
+        CovidApi(client=client).save_snapshot(snapshot_file)
+        _report("metadata from payloads", _measure(lambda _: CovidApi(client=client), [None], args.repeat), "ms")
+        _report("metadata snapshot", _measure(lambda _: CovidApi(snapshot_file=snapshot_file), [None], args.repeat), "ms")
+    if seconds * 1e3 > args.budget:
+        sys.exit("Importing bot.py took {:.0f} ms, more than the budget of {:.0f} ms".format(seconds * 1e3, args.budget))
+
+
+BENCHMARKS = {
+    "dispatch": bench_dispatch,
+    "inline": bench_inline,
+    "persistence": bench_persistence,
+    "startup": bench_startup,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for hot paths of @coronaviruskenyabot")
+    parser.add_argument("benchmark", type=str, choices=BENCHMARKS.keys(), help="benchmark to run")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs, the fastest one is reported")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="database sizes")
+    parser.add_argument("--updates", type=int, default=50, help="number of updates per database size")
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET,
+                        help="startup: fail if importing bot.py takes longer (ms)")
+    parser.add_argument("--profile-startup", action="store_true", help="startup: report the import time per module")
+    parser.add_argument("--top", type=int, default=25, help="startup: number of modules in the profile")
+
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
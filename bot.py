@@ -1,24 +1,37 @@
 #!/usr/bin/env python3
-from datetime import datetime
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, time, timedelta
+from functools import partial
+import hashlib
+import io
 import json
 import logging
 import math
-import re
-from time import sleep
+import sys
 
 from telegram import ParseMode
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, InlineQueryHandler
-from telegram.ext import PicklePersistence, ConversationHandler
-from telegram.error import TelegramError
-
+from telegram.ext import ConversationHandler
+from telegram.error import TelegramError, BadRequest
+
+from broadcast import Broadcaster
+from handlers import CountryCommandHandler
+from media_cache import ImageCache, FileIdCache, MapCache
+from persistence import make_persistence
+from prefetch import Prefetcher
 from statistics_api import CovidApi
+from subscribers import SLOT_MINUTES, SubscriberRegistry, next_slot_start, slot_of, slot_time
 import wikidata
 from resources.resolver import resolve
 from utils import *
-from plot import plot_timeseries, plot_vaccinations_series
+from render import RenderService
 
 CONFIG_FILE="config.json"
+METADATA_FILE="metadata.json"
+LAST_GOOD_FILE="last_good.json"
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
@@ -27,7 +40,16 @@ logger = logging.getLogger(__name__)
 
 WORLD_IDENT="world"
 
-api = CovidApi()
+# the countries and states are loaded from the snapshot of the last run, main starts refreshing them
+api = CovidApi(snapshot_file=METADATA_FILE, timeseries_dir="cache/timeseries", last_good_file=LAST_GOOD_FILE)
+plot_cache = ImageCache(directory="cache/plots")
+# (kind, country code) -> number of requests of the chart
+requested_plots = Counter()
+file_ids = FileIdCache()
+# only used if the map_cache option is set
+map_cache = MapCache(directory="cache/maps")
+renderer = RenderService()
+subscribers = SubscriberRegistry()
 
 # command /start
 def command_start(update, context):
@@ -63,6 +85,26 @@ def get_name_and_icon(code, icon=None):
         icon = flag(code)
     return name, icon
 
+# the trend metrics of a country or the world, states have none
+def get_metrics(code):
+    if code == WORLD_IDENT:
+        return api.metrics()
+    elif code in api.countries:
+        return api.metrics(code)
+    else:
+        return {}
+
+def has_trend(metrics):
+    return not math.isnan(metrics.get('casesAvg7', math.nan)) and not math.isnan(metrics.get('casesGrowth', math.nan))
+
+def format_trend(metrics, lang):
+    return resolve('today_trend', lang, metrics['casesAvg7'], metrics['casesGrowth']) if has_trend(metrics) else ''
+
+# a warning if the API is down and the data is the last that could be fetched
+def format_data_as_of(lang):
+    as_of = api.data_as_of()
+    return '\n'+resolve('data_as_of', lang, as_of) if as_of else ''
+
 def format_stats(update, code, data, icon=None, detailed=True):
     name, icon = get_name_and_icon(code, icon=icon)
     p_dead = data['deaths'] / data['cases']
@@ -76,9 +118,18 @@ def format_stats(update, code, data, icon=None, detailed=True):
         if detailed:
             text += '\n'+resolve('stats_table_more', lang(update), data['casesPerOneMillion'],
                             data['deathsPerOneMillion'], data['testsPerOneMillion'])
+            metrics = get_metrics(code)
+            if has_trend(metrics):
+                text += '\n'+resolve('stats_trend', lang(update), metrics['casesAvg7'], metrics['casesGrowth'])
+                # the population of some places is unknown
+                if not math.isnan(metrics['casesAvg7PerMillion']):
+                    text += resolve('stats_trend_per_million', lang(update), metrics['casesAvg7PerMillion'])
+                if not math.isnan(metrics['casesDoublingTime']):
+                    text += resolve('stats_doubling', lang(update), metrics['casesDoublingTime'])
     else: # we only have limited data
         text = resolve('stats_table_simple', lang(update), name, icon, data['cases'], data['deaths'], p_dead)
     text += '\n'+resolve('stats_updated', lang(update), datetime.utcfromtimestamp(data['updated'] / 1e3))
+    text += format_data_as_of(lang(update))
     return text
 
 def get_stats_keyboard(update, country_code):
@@ -95,21 +146,28 @@ def get_stats_keyboard(update, country_code):
 # the text used for daily notifications and /today
 def get_status_report(country_code=None, lang="en"):
     data = api.cases_world()
+    # fetch data of home country if set
+    country_data = api.cases_country(country_code) if data and country_code else None
+    return render_status_report(data, country_code, country_data, lang)
+
+def render_status_report(data, country_code, country_data, lang="en"):
     if data:
         dt = datetime.utcfromtimestamp(data['updated'] / 1e3)
         text = resolve('today', lang,
-                dt, dt, data['cases'], data['deaths'], data['todayCases'], data['todayDeaths'], data['vaccinations'])
-        # fetch data of home country if set
+                dt, dt, data['cases'], data['deaths'], data['todayCases'], data['todayDeaths'], data['vaccinations'],
+                format_trend(api.metrics(), lang))
         if country_code:
-            country_data = api.cases_country(country_code)
-            text += '\n'+resolve('today_country', lang, flag(country_code),
-                            api.countries[country_code]['name'], country_data['cases'], country_data['deaths'],
-                            country_data['todayCases'], country_data['todayDeaths'],
-                            country_data.get('vaccinations', math.nan), country_code.lower()
-                        )
+            if country_data:
+                text += '\n'+resolve('today_country', lang, flag(country_code),
+                                get_name_and_icon(country_code)[0], country_data['cases'], country_data['deaths'],
+                                country_data['todayCases'], country_data['todayDeaths'],
+                                country_data.get('vaccinations', math.nan),
+                                format_trend(api.metrics(country_code), lang), country_code.lower()
+                            )
         else:
             text += '\n_'+resolve('no_country_set', lang)+'_\n'
         text += '\n'+resolve('today_footer', lang)
+        text += format_data_as_of(lang)
     else:
         text = resolve('no_data',lang)
     return text
@@ -157,9 +215,19 @@ SORT_ORDERS = [
     'cases', 'deaths',
     'casesPerOneMillion', 'deathsPerOneMillion',
     'todayCases', 'todayDeaths',
-    'vaccinations',
+    'vaccinations', 'vaccinationsPerHundred',
+    'casesAvg7PerMillion', 'casesGrowth',
 ]
 
+# returns the countries on a page of the list, their page number and if it is the last page
+# a negative page number returns the last page
+def get_list_page(order, page, limit):
+    ranking = api.country_ranking(SORT_ORDERS)
+    count = ranking.count(order)
+    if page < 0:
+        page = max(0, (count - 1) // limit)
+    return ranking.page(order, page * limit, limit), page, (page + 1) * limit >= count
+
 def get_list_order_keyboard(update, current_index, limit, last=False):
     keyboard = []
     l = None
@@ -176,41 +244,27 @@ def get_list_order_keyboard(update, current_index, limit, last=False):
                 callback_data="list_order_menu 0 ({} {} {})".format(current_index, limit, int(last)))])
     return InlineKeyboardMarkup(keyboard)
 
-# command /world
-@handler_decorator
-def command_world(update, context):
-    data = api.cases_world()
+# answers with the statistics of a place, states have no buttons as there are no maps and graphs of them
+def reply_stats(update, code, data, icon=None, buttons=True):
     if data:
-        text = format_stats(update, WORLD_IDENT, data)
-        update.message.reply_markdown(text, reply_markup=get_stats_keyboard(update, WORLD_IDENT))
+        text = format_stats(update, code, data, icon=icon)
+        update.message.reply_markdown(text, reply_markup=get_stats_keyboard(update, code) if buttons else None)
     else:
         update.message.reply_text(resolve('no_data', lang(update)))
 
+# command /world
+@handler_decorator
+def command_world(update, context):
+    reply_stats(update, WORLD_IDENT, api.cases_world())
+
 # command /[country]
 @handler_decorator
 def command_country(update, context, country_code):
-    data = api.cases_country(country_code)
-    if data:
-        text = format_stats(update, country_code, data)
-        update.message.reply_markdown(text, reply_markup=get_stats_keyboard(update, country_code))
-    else:
-        update.message.reply_text(resolve('no_data', lang(update)))
+    reply_stats(update, country_code, api.cases_country(country_code))
 
-def command_us_state(update, context, state):
-    data = api.cases_us_state(state)
-    if data:
-        text = format_stats(update, state.title(), data, icon='\uD83C\uDDFA\uD83C\uDDF8')
-        update.message.reply_markdown(text)
-    else:
-        update.message.reply_text(resolve('no_data', lang(update)))
-
-def command_de_state(update, context, state):
-    data = api.cases_de_state(state)
-    if data:
-        text = format_stats(update, state.title(), data, icon='\uD83C\uDDE9\uD83C\uDDEA')
-        update.message.reply_markdown(text)
-    else:
-        update.message.reply_text(resolve('no_data', lang(update)))
+# states of a region, e.g. a US state
+def command_state(update, context, region, state):
+    reply_stats(update, state.title(), api.cases_region(region, state), icon=flag(region), buttons=False)
 
 ### Country list ###
 
@@ -218,7 +272,7 @@ def command_de_state(update, context, state):
 @handler_decorator
 def command_list(update, context):
     # set or retrieve sort order
-    if len(context.args) > 0:
+    if len(context.args) > 0 and context.args[0] in SORT_ORDERS:
         order = context.args[0]
         context.chat_data['order'] = order
     elif 'order' in context.chat_data:
@@ -230,15 +284,12 @@ def command_list(update, context):
     # by default, return 8 items. min 2 and max 20.
     limit = int(context.args[1]) if len(context.args) > 1 else 8
     limit = min(max(2, limit), 20)
-    if order in ["vaccinations"]:
-        case_list = api.vaccinations_country_list(sort_by=order)[:limit]
-    else:
-        case_list = api.cases_country_list(sort_by=order)[:limit]
+    case_list, _, last = get_list_page(order, 0, limit)
     if len(case_list) > 0:
         text = resolve('list_header', lang(update), resolve("sort_order_"+order, lang(update)))
         for item in case_list:
             text += format_list_item(item, order)
-        update.message.reply_markdown(text, reply_markup=get_list_keyboard(update, 0, limit))
+        update.message.reply_markdown(text, reply_markup=get_list_keyboard(update, 0, limit, last))
     else:
         update.message.reply_text(resolve('no_data', lang(update)))
 
@@ -246,27 +297,19 @@ def callback_list_pages(update, context):
     query = update.callback_query
     order = context.chat_data.get('order', SORT_ORDERS[0]) # for backward comp
     page, limit = int(context.match.group(1)), int(context.match.group(2))
-    if order in ["vaccinations"]:
-        case_list = api.vaccinations_country_list(sort_by=order)
-    else:
-        case_list = api.cases_country_list(sort_by=order)
-    if page >= 0:
-        case_list = case_list[page*limit:(page+1)*limit]
-    else:
-        # if the given page number is negative, we want to access the last page
-        page = len(case_list) // limit
-        offset = len(case_list) % limit
-        case_list = case_list[-offset:]
+    if order not in SORT_ORDERS:
+        order = SORT_ORDERS[0]
+    case_list, page, last = get_list_page(order, page, limit)
     query.answer()
     if len(case_list) > 0:
         text = resolve('list_header', lang(update), resolve("sort_order_"+order, lang(update)))
         for item in case_list:
             text += format_list_item(item, order)
         query.edit_message_text(text=text, parse_mode=ParseMode.MARKDOWN,
-                                reply_markup=get_list_keyboard(update, page, limit, len(case_list) < limit))
+                                reply_markup=get_list_keyboard(update, page, limit, last))
     else:
         query.edit_message_text(resolve('no_data', lang(update)),
-                                reply_markup=get_list_keyboard(update, page, limit, len(case_list) < limit))
+                                reply_markup=get_list_keyboard(update, page, limit, last))
 
 def callback_list_order_menu(update, context):
     query = update.callback_query
@@ -281,98 +324,139 @@ def callback_list_order_menu(update, context):
 def callback_list_order(update, context):
     query = update.callback_query
     order = context.match.group(1)
+    if order not in SORT_ORDERS:
+        order = SORT_ORDERS[0]
     # save the selected order
     context.chat_data['order'] = order
     limit = int(context.match.group(2))
-    if order in ["vaccinations"]:
-        case_list = api.vaccinations_country_list(sort_by=order)[:limit]
-    else:
-        case_list = api.cases_country_list(sort_by=order)[:limit]
+    case_list, _, last = get_list_page(order, 0, limit)
     query.answer()
     if len(case_list) > 0:
         text = resolve('list_header', lang(update), resolve("sort_order_"+order, lang(update)))
         for item in case_list:
             text += format_list_item(item, order)
         query.edit_message_text(text=text, parse_mode=ParseMode.MARKDOWN,
-                                reply_markup=get_list_keyboard(update, 0, limit, len(case_list) < limit))
+                                reply_markup=get_list_keyboard(update, 0, limit, last))
     else:
         query.edit_message_text(resolve('no_data', lang(update)),
-                                reply_markup=get_list_keyboard(update, 0, limit, len(case_list) < limit))
+                                reply_markup=get_list_keyboard(update, 0, limit, last))
 
 ### Map ###
 
+def get_map_url(code, timestamp=True):
+    if code == WORLD_IDENT:
+        return wikidata.cases_world_map(timestamp)
+    else:
+        return wikidata.cases_country_map(code, timestamp)
+
+# Sends the map of a country or the world, returns None if there is none. If the map cache is enabled, the
+# image is uploaded from it and then sent by its file_id, otherwise Telegram downloads it from Wikimedia.
+def send_map(send_photo, code, caption):
+    url = get_map_url(code, timestamp=False)
+    if not url:
+        return None
+    image = map_cache.get(url) if map_cache.enabled else None
+    if image is None:
+        return send_photo(photo=get_map_url(code), caption=caption, parse_mode=ParseMode.MARKDOWN)
+    key = ('map', url, hashlib.sha1(image).hexdigest())
+    file_id = file_ids.get(key)
+    if file_id:
+        try:
+            return send_photo(photo=file_id, caption=caption, parse_mode=ParseMode.MARKDOWN)
+        except BadRequest:
+            file_ids.invalidate(key)
+    message = send_photo(photo=io.BytesIO(image), caption=caption, parse_mode=ParseMode.MARKDOWN)
+    if message and message.photo:
+        file_ids.put(key, message.photo[-1].file_id)
+    return message
+
 # command: /map
 @handler_decorator
 def command_map(update, context):
-    code = None
     if len(context.args) > 0:
         resolved = resolve_query_string(context.args[0])
         if resolved:
             code = resolved
-            photo = wikidata.cases_country_map(code)
         elif WORLD_IDENT in context.args[0]:
             code = WORLD_IDENT
-            photo = wikidata.cases_world_map()
         else:
             update.message.reply_text(resolve('unknown_place', lang(update)))
             return
     else:
-        if 'country' in context.chat_data:
-            code = context.chat_data['country']
-            photo = wikidata.cases_country_map(code)
-        else:
-            code = WORLD_IDENT
-            photo = wikidata.cases_world_map()
-    if photo:
-        caption = resolve("map_caption", lang(update), *get_name_and_icon(code))
-        update.message.reply_photo(photo=photo, caption=caption, parse_mode=ParseMode.MARKDOWN)
-    else:
+        code = context.chat_data.get('country', WORLD_IDENT)
+    caption = resolve("map_caption", lang(update), *get_name_and_icon(code))
+    if not send_map(update.message.reply_photo, code, caption):
         update.message.reply_text(resolve('unknown_place', lang(update)))
 
 @handler_decorator
 def callback_map(update, context):
     code = context.match.group(1)
-    if code == WORLD_IDENT:
-        photo = wikidata.cases_world_map()
-    else:
-        photo = wikidata.cases_country_map(code)
-    if photo:
-        caption = resolve("map_caption", lang(update), *get_name_and_icon(code))
-        update.callback_query.answer()
-        context.bot.send_photo(
-            chat_id=update.callback_query.message.chat_id,
-            photo=photo, caption=caption,
-            parse_mode=ParseMode.MARKDOWN,
-        )
-    else:
-        update.callback_query.answer()
+    caption = resolve("map_caption", lang(update), *get_name_and_icon(code))
+    update.callback_query.answer()
+    if not send_map(partial(context.bot.send_photo, chat_id=update.callback_query.message.chat_id), code, caption):
         context.bot.send_message(chat_id=update.callback_query.message.chat_id, text=resolve('no_data', lang(update)))
 
 ### Graphs ###
 
+# the data series whose length identifies the number of days of each chart type
+PLOT_SERIES = {
+    'cases': 'cases',
+    'vacc': 'vaccinations',
+}
+
+# sends the chart of the given type, reusing a previous upload or rendering of the same chart if possible
+def plot_key(kind, code, data):
+    return (kind, code or WORLD_IDENT, data['last_date'].strftime('%Y-%m-%d'), len(data[PLOT_SERIES[kind]]))
+
+def get_plot_image(kind, code, data):
+    key = plot_key(kind, code, data)
+    image = plot_cache.get(key)
+    if image is None:
+        image = renderer.render(kind, data)
+        if image is not None:
+            plot_cache.put(key, image)
+    return image
+
+def send_plot(send_photo, kind, code, data):
+    requested_plots[(kind, code)] += 1
+    key = plot_key(kind, code, data)
+    file_id = file_ids.get(key)
+    if file_id:
+        try:
+            return send_photo(photo=file_id)
+        except BadRequest:
+            file_ids.invalidate(key)
+    image = get_plot_image(kind, code, data)
+    if image is None:
+        return None
+    message = send_photo(photo=io.BytesIO(image))
+    if message and message.photo:
+        file_ids.put(key, message.photo[-1].file_id)
+    return message
+
+# renders the charts that were requested most often, so they are ready when the next users ask for them
+def prerender_plots(top):
+    for (kind, code), _ in requested_plots.most_common(top):
+        data = api.timeseries(code) if kind == 'cases' else api.vaccinations_series(code)
+        if data:
+            get_plot_image(kind, code, data)
+
 # command: /graph
 @handler_decorator
 def command_graph(update, context):
     if len(context.args) > 0:
         resolved = resolve_query_string(context.args[0])
         if resolved:
-            data = api.timeseries(resolved)
+            country_code = resolved
         elif WORLD_IDENT in context.args[0]:
-            data = api.timeseries()
+            country_code = None
         else:
             update.message.reply_text(resolve('unknown_place', lang(update)))
             return
     else:
-        if 'country' in context.chat_data:
-            country_code = context.chat_data['country']
-            data = api.timeseries(country_code)
-        else:
-            data = api.timeseries()
-    if data:
-        buffer = plot_timeseries(data)
-        update.message.reply_photo(photo=buffer)
-        buffer.close()
-    else:
+        country_code = context.chat_data.get('country', None)
+    data = api.timeseries(country_code)
+    if not data or send_plot(update.message.reply_photo, 'cases', country_code, data) is None:
         update.message.reply_text(resolve('no_data', lang(update)))
 
 @handler_decorator
@@ -381,13 +465,9 @@ def callback_graph(update, context):
     if country_code == WORLD_IDENT:
         country_code = None
     data = api.timeseries(country_code)
-    if data:
-        buffer = plot_timeseries(data)
-        update.callback_query.answer()
-        context.bot.send_photo(chat_id=update.callback_query.message.chat_id, photo=buffer)
-        buffer.close()
-    else:
-        update.callback_query.answer()
+    update.callback_query.answer()
+    send_photo = partial(context.bot.send_photo, chat_id=update.callback_query.message.chat_id)
+    if not data or send_plot(send_photo, 'cases', country_code, data) is None:
         context.bot.send_message(chat_id=update.callback_query.message.chat_id, text=resolve('no_data', lang(update)))
 
 ### Vaccinations ###
@@ -398,23 +478,16 @@ def command_vacc(update, context):
     if len(context.args) > 0:
         resolved = resolve_query_string(context.args[0])
         if resolved:
-            data = api.vaccinations_series(resolved)
+            country_code = resolved
         elif WORLD_IDENT in context.args[0]:
-            data = api.vaccinations_series()
+            country_code = None
         else:
             update.message.reply_text(resolve('unknown_place', lang(update)))
             return
     else:
-        if 'country' in context.chat_data:
-            country_code = context.chat_data['country']
-            data = api.vaccinations_series(country_code)
-        else:
-            data = api.vaccinations_series()
-    if data:
-        buffer = plot_vaccinations_series(data)
-        update.message.reply_photo(photo=buffer)
-        buffer.close()
-    else:
+        country_code = context.chat_data.get('country', None)
+    data = api.vaccinations_series(country_code)
+    if not data or send_plot(update.message.reply_photo, 'vacc', country_code, data) is None:
         update.message.reply_text(resolve('no_data', lang(update)))
 
 @handler_decorator
@@ -423,13 +496,9 @@ def callback_vacc(update, context):
     if country_code == WORLD_IDENT:
         country_code = None
     data = api.vaccinations_series(country_code)
-    if data:
-        buffer = plot_vaccinations_series(data)
-        update.callback_query.answer()
-        context.bot.send_photo(chat_id=update.callback_query.message.chat_id, photo=buffer)
-        buffer.close()
-    else:
-        update.callback_query.answer()
+    update.callback_query.answer()
+    send_photo = partial(context.bot.send_photo, chat_id=update.callback_query.message.chat_id)
+    if not data or send_plot(send_photo, 'vacc', country_code, data) is None:
         context.bot.send_message(chat_id=update.callback_query.message.chat_id, text=resolve('no_data', lang(update)))
 
 ### Free text & inline ###
@@ -453,62 +522,167 @@ def handle_text(update, context):
         command_country(update, context, resolved)
     elif WORLD_IDENT in query_string:
         command_world(update, context)
-    elif query_string.title() in api.us_states:
-        command_us_state(update, context, query_string)
-    elif query_string.title() in api.de_states:
-        command_de_state(update, context, query_string)
     else:
-        update.message.reply_text(resolve('unknown_place', lang(update)))
+        region = api.find_region(query_string)
+        if region:
+            command_state(update, context, region, query_string)
+        else:
+            update.message.reply_text(resolve('unknown_place', lang(update)))
 
-# inline queries
-def handle_inlinequery(update, context):
-    inline_query = update.inline_query
-    query_string = inline_query.query.lower()
-    if not query_string:
-        return
+# seconds to wait for the data of inline results, Telegram drops answers that arrive too late
+INLINE_DEADLINE = 4
+# seconds Telegram may cache the answer to an inline query
+INLINE_CACHE_TIME = 300
+
+inline_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="inline")
+
+def _inline_fetches(s, t):
+    if t == WORLD_IDENT:
+        return [inline_executor.submit(api.cases_world, include_vaccinations=False),
+                inline_executor.submit(api.vaccinations_world)]
+    elif t.endswith("_state"):
+        return [inline_executor.submit(api.cases_region, t[:-len("_state")], s)]
+    else:
+        # the vaccinations are in the joined row of the country, no need to fetch them separately
+        return [inline_executor.submit(api.cases_country, api.name_map[s])]
+
+# the results of the fetches that finished before the deadline, None for the others
+def _inline_results(fetches, done):
+    return [[f.result() if f in done and not f.exception() else None for f in futures] for futures in fetches]
+
+# the places matching an inline query, as (name, kind)
+def inline_places(query_string):
     results = []
     # a special case matching 'world'
     if WORLD_IDENT.startswith(query_string):
         results.append((WORLD_IDENT, WORLD_IDENT))
-    for name in api.name_map.keys():
-        if name.startswith(query_string):
-            results.append((name, "country"))
-        # limit to the first threee results
-        if len(results) >= 3:
-            break
-    if len(results) < 3:
-        for state in api.us_states:
-            if state.lower().startswith(query_string):
-                results.append((state.lower(), "us_state"))
-            if len(results) >= 3:
-                break
-    if len(results) < 3:
-        for state in api.de_states:
-            if state.lower().startswith(query_string):
-                results.append((state.lower(), "de_state"))
-            if len(results) >= 3:
-                break
+    # limit to the first three results
+    results += [(name, kind) for name, kind, _ in api.index.search(query_string, k=3 - len(results))]
+    return results
+
+# inline queries
+def handle_inlinequery(update, context):
+    query_string = update.inline_query.query.lower()
+    if not query_string:
+        return
+    results = inline_places(query_string)
+    # fetch the data of all results concurrently and answer with whatever arrived before the deadline
+    fetches = [_inline_fetches(s, t) for s, t in results]
+    done, not_done = wait([f for futures in fetches for f in futures], timeout=INLINE_DEADLINE)
+    # the answer is sent without them, so the fetches that have not started yet must not occupy the executor
+    for f in not_done:
+        f.cancel()
+    answer_inline_query(update, results, _inline_results(fetches, done))
+
+# answers with the statistics of the places, `fetched` holds the data and, of the world, the vaccinations
+def answer_inline_query(update, results, fetched):
     query_results = []
-    for i,(s, t) in enumerate(results):
+    for i,((s, t), values) in enumerate(zip(results, fetched)):
+        data = values[0]
+        if not data:
+            continue
+        if len(values) > 1:
+            vacc = values[1]
+            data = dict(data, vaccinations=vacc['vaccinations'] if vacc else math.nan)
         if t == WORLD_IDENT:
-            data = api.cases_world()
             text = format_stats(update, WORLD_IDENT, data, detailed=True)
-        elif t == "us_state":
-            data = api.cases_us_state(s)
-            text = format_stats(update, s.title(), data, icon='\uD83C\uDDFA\uD83C\uDDF8')
-        elif t == "de_state":
-            data = api.cases_de_state(s)
-            text = format_stats(update, s.title(), data, icon='\uD83C\uDDE9\uD83C\uDDEA')
+        elif t.endswith("_state"):
+            text = format_stats(update, s.title(), data, icon=flag(t[:-len("_state")]))
         else:
-            country_code = api.name_map[s]
-            data = api.cases_country(country_code)
-            text = format_stats(update, country_code, data, detailed=True)
+            text = format_stats(update, api.name_map[s], data, detailed=True)
         text+='\n'+resolve('more', lang(update))
         result_content = InputTextMessageContent(text, parse_mode=ParseMode.MARKDOWN)
         query_results.append(
             InlineQueryResultArticle(id=i, title=s, input_message_content=result_content)
         )
-    inline_query.answer(query_results)
+    # the texts are in the language of the user, so Telegram must not reuse the answer for other users
+    update.inline_query.answer(query_results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+### Asyncio handler path ###
+
+# With the async_handlers option, the handlers that wait for the API run as coroutines in an event loop, see
+# start_event_loop. The data is fetched with AsyncCovidApi, the answers are sent in the thread pool of the loop.
+event_loop = None
+api_async = None
+
+def start_event_loop(config):
+    global event_loop, api_async
+    # aiohttp is only imported if the option is set
+    from async_api import AsyncCovidApi, EventLoopThread
+    event_loop = EventLoopThread(workers=config.get('async_send_workers', 8))
+    api_async = AsyncCovidApi(api)
+    event_loop.start()
+
+def stop_event_loop():
+    if event_loop:
+        event_loop.stop(api_async.close())
+
+# a handler that hands the coroutine to the event loop and returns right away
+def run_async(coroutine_function):
+    def handler(update, context, *args):
+        event_loop.submit(coroutine_function(update, context, *args))
+    return handler
+
+async def command_today_async(update, context):
+    country_code = context.chat_data.get('country')
+    data = await api_async.cases_world()
+    country_data = await api_async.cases_country(country_code) if data and country_code else None
+    text = render_status_report(data, country_code, country_data, lang(update))
+    await event_loop.blocking(update.message.reply_markdown, text)
+
+async def command_world_async(update, context):
+    await event_loop.blocking(reply_stats, update, WORLD_IDENT, await api_async.cases_world())
+
+async def command_country_async(update, context, country_code):
+    await event_loop.blocking(reply_stats, update, country_code, await api_async.cases_country(country_code))
+
+async def handle_text_async(update, context):
+    query_string = update.message.text.lower()
+    resolved = resolve_query_string(query_string)
+    if resolved:
+        await command_country_async(update, context, resolved)
+    elif WORLD_IDENT in query_string:
+        await command_world_async(update, context)
+    else:
+        region = await api_async.find_region(query_string)
+        if region:
+            data = await api_async.cases_region(region, query_string)
+            await event_loop.blocking(reply_stats, update, query_string.title(), data, icon=flag(region), buttons=False)
+        else:
+            await event_loop.blocking(update.message.reply_text, resolve('unknown_place', lang(update)))
+
+async def command_map_async(update, context):
+    code = context.chat_data.get('country', WORLD_IDENT)
+    if len(context.args) > 0:
+        code = resolve_query_string(context.args[0]) or (WORLD_IDENT if WORLD_IDENT in context.args[0] else None)
+    # resolve the maps without blocking, sending them may download the image from the map cache
+    if code and code != WORLD_IDENT:
+        await api_async.cases_country_map(code)
+    if code:
+        caption = resolve("map_caption", lang(update), *get_name_and_icon(code))
+        if await event_loop.blocking(send_map, update.message.reply_photo, code, caption):
+            return
+    await event_loop.blocking(update.message.reply_text, resolve('unknown_place', lang(update)))
+
+def _inline_coroutines(s, t):
+    if t == WORLD_IDENT:
+        return [api_async.cases_world(include_vaccinations=False), api_async.vaccinations_world()]
+    elif t.endswith("_state"):
+        return [api_async.cases_region(t[:-len("_state")], s)]
+    else:
+        return [api_async.cases_country(api.name_map[s])]
+
+async def handle_inlinequery_async(update, context):
+    query_string = update.inline_query.query.lower()
+    if not query_string:
+        return
+    results = inline_places(query_string)
+    fetches = [[asyncio.ensure_future(c) for c in _inline_coroutines(s, t)] for s, t in results]
+    tasks = [f for futures in fetches for f in futures]
+    done, pending = await asyncio.wait(tasks, timeout=INLINE_DEADLINE) if tasks else (set(), set())
+    for task in pending:
+        task.cancel()
+    await event_loop.blocking(answer_inline_query, update, results, _inline_results(fetches, done))
 
 ### Set country ###
 
@@ -537,38 +711,78 @@ def handle_setcountry_cancel(update, context):
 
 @handler_decorator
 def command_subscribe(update, context):
-    if not 'subscribers' in context.bot_data:
-        context.bot_data['subscribers'] = [update.message.chat.id]
-    elif not update.message.chat.id in context.bot_data['subscribers']:
-        context.bot_data['subscribers'].append(update.message.chat.id)
-    update.message.reply_markdown(resolve('subscribe', lang(update)))
+    chat_id = update.message.chat.id
+    slot = None
+    if context.args:
+        try:
+            slot = slot_of(datetime.strptime(context.args[0], '%H:%M').time())
+        except ValueError:
+            update.message.reply_markdown(resolve('subscribe_invalid_time', lang(update)))
+            return
+    sync_subscribers(context.dispatcher)
+    # remember the language for the daily notifications
+    subscribers.subscribe(chat_id, lang(update), slot)
+    notify_time = subscribers.notify_time(chat_id)
+    if notify_time:
+        update.message.reply_markdown(resolve('subscribe_time', lang(update), notify_time.strftime('%H:%M')))
+    else:
+        update.message.reply_markdown(resolve('subscribe', lang(update)))
 
 @handler_decorator
 def command_unsubscribe(update, context):
-    if 'subscribers' in context.bot_data:
-        if update.message.chat.id in context.bot_data['subscribers']:
-            context.bot_data['subscribers'].remove(update.message.chat.id)
+    sync_subscribers(context.dispatcher)
+    subscribers.unsubscribe(update.message.chat.id)
     update.message.reply_markdown(resolve('unsubscribe', lang(update)))
 
-# runs the status notification job once per day
+# Runs at the start of every slot and notifies the chats subscribed to it, so the notifications are spread over the
+# day in small waves. The messages are sent by the broadcaster in context.job.context.
 def run_notify(context):
-    if not 'subscribers' in context.bot_data:
-        logger.warn("No subscribers list specified.")
+    now = datetime.utcnow()
+    slot = slot_of(now.time())
+    chats = subscribers.in_slot(slot)
+    if not chats:
         return
-    count = 0
-    for chat_id in context.bot_data['subscribers']:
-        try:
-            country_code = context.dispatcher.chat_data[chat_id].get('country', None)
-            text = get_status_report(country_code=country_code) # TODO always English
-            context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN)
-            count+=1
-            sleep(0.05) # try to avoid flood limits
-        except Exception as ex:
-            # remove user from subscribers if he blocked or kicked the bot
-            if isinstance(ex, TelegramError) and ex.message.startswith("Forbidden: "):
-                context.bot_data['subscribers'].remove(chat_id)
-            logger.error("Failed to send daily notification to {}".format(chat_id), exc_info=True)
-    logger.info("Successfully sent daily notification to {} users.".format(count))
+    # group the subscribers by home country and language, so every distinct message is only fetched and rendered once
+    recipients = []
+    persistence = context.dispatcher.persistence
+    shared = getattr(persistence, 'shared', False)
+    for chat_id, lang_code in chats:
+        # the other webhook workers change the data of their chats, so it is read from the database
+        chat_data = persistence.load_chat_data(chat_id) if shared else context.dispatcher.chat_data[chat_id]
+        recipients.append((chat_id, (chat_data.get('country', None), lang_code or 'en')))
+    world_data = api.cases_world()
+    country_data = {}
+    texts = []
+    text_index = {}
+    for _, key in recipients:
+        if key in text_index:
+            continue
+        country_code, lang_code = key
+        if world_data and country_code and not country_code in country_data:
+            country_data[country_code] = api.cases_country(country_code)
+        text_index[key] = len(texts)
+        texts.append(render_status_report(world_data, country_code, country_data.get(country_code), lang_code))
+    logger.info("Rendered {} distinct notifications for {} subscribers.".format(len(texts), len(recipients)))
+    broadcast_id = "notify-{}-{}".format(now.strftime('%Y-%m-%d'), slot_time(slot).strftime('%H%M'))
+    context.job.context.start(broadcast_id, texts, [(chat_id, text_index[key]) for chat_id, key in recipients])
+
+# saves the subscriptions of this worker and loads the ones of all workers, before the next wave is sent
+def reload_subscribers(persistence, bot_data):
+    persistence.update_bot_data(bot_data)
+    persistence.reload_bot_data()
+    subscribers.load(bot_data)
+
+# The first webhook worker unsubscribes the chats that blocked the bot, so the subscriptions are loaded again before
+# they are changed. Otherwise a chat could not subscribe again, as its worker still has it subscribed.
+def sync_subscribers(dispatcher):
+    if getattr(dispatcher.persistence, 'shared', False):
+        reload_subscribers(dispatcher.persistence, dispatcher.bot_data)
+
+# runs in the webhook workers except the first one, which keeps the shared files up to date
+def reload_shared(context):
+    api.reload()
+    if map_cache.enabled:
+        map_cache.reload()
 
 def error(update, context):
     try:
@@ -576,8 +790,33 @@ def error(update, context):
     except TelegramError:
         logger.warning('Update {} caused error "{}"'.format(update, context.error))
 
-def main(config):
-    persistence = PicklePersistence("database.pkl")
+# Sets up the updater of a bot process. In webhook mode, several worker processes share the database and the
+# files in the cache directory. Only the first one (worker 0) polls the API and sends the notifications, the others
+# load the files it saves. Returns the updater and a function to call once it stopped.
+def setup(config, worker=0):
+    api.ttls.update(config.get('cache_ttls', {}))
+    if 'http_timeout' in config:
+        api.client.timeout = config['http_timeout']
+    shared = config.get('webhook_workers', 1) > 1
+    # fork the render workers before the updater starts its threads
+    renderer.workers = config.get('render_workers', renderer.workers)
+    renderer.start()
+    if worker == 0:
+        api.start_refresh(config.get('metadata_interval', 3600))
+    # write every chart to disk right away, so the other workers do not have to render it again
+    plot_cache.write_through = shared
+    persistence = make_persistence(config)
+    if hasattr(persistence, 'shared'):
+        persistence.shared = shared
+    # the handlers that wait for the API, as coroutines in an event loop if the async_handlers option is set
+    if config.get('async_handlers', False):
+        start_event_loop(config)
+        today, world, country, country_map, text, inline = [handler_decorator(run_async(handler)) for handler in (
+            command_today_async, command_world_async, command_country_async, command_map_async, handle_text_async)
+        ] + [run_async(handle_inlinequery_async)]
+    else:
+        today, world, country, country_map, text, inline = (
+            command_today, command_world, command_country, command_map, handle_text, handle_inlinequery)
     updater = Updater(config['token'], persistence=persistence, use_context=True)
     # add commands
     dp = updater.dispatcher
@@ -586,11 +825,11 @@ def main(config):
     dp.add_handler(CommandHandler("donate", command_donate))
     dp.add_handler(CommandHandler("faqs1", command_faqs1))
     dp.add_handler(CommandHandler("faqs2", command_faqs2))
-    dp.add_handler(CommandHandler("today", command_today))
-    dp.add_handler(CommandHandler("world", command_world))
+    dp.add_handler(CommandHandler("today", today))
+    dp.add_handler(CommandHandler("world", world))
     dp.add_handler(CommandHandler("list", command_list))
     # map
-    dp.add_handler(CommandHandler("map", command_map))
+    dp.add_handler(CommandHandler("map", country_map))
     dp.add_handler(CallbackQueryHandler(callback_map, pattern=r"map (\w+)"))
     # graphs
     dp.add_handler(CommandHandler("graph", command_graph))
@@ -601,14 +840,8 @@ def main(config):
     dp.add_handler(CallbackQueryHandler(callback_list_pages, pattern=r"list (-?\d+) (\d+)"))
     dp.add_handler(CallbackQueryHandler(callback_list_order_menu, pattern=r"list_order_menu (\d+) \(([\d\s]+)\)"))
     dp.add_handler(CallbackQueryHandler(callback_list_order, pattern=r"list_order (\w+) (\d+)"))
-    # for every country, add a command for the iso2 and iso3 codes and the name
-    for iso, country in api.countries.items():
-        callback = lambda update, context, code=iso: command_country(update, context, code)
-        dp.add_handler(CommandHandler(iso, callback))
-        if country['iso3']:
-            dp.add_handler(CommandHandler(country['iso3'], callback))
-        name_normal = re.sub(r"[^a-z]", "_", country['name'].lower())
-        dp.add_handler(CommandHandler(name_normal, callback))
+    # the iso2 and iso3 codes and the name of every country are commands
+    dp.add_handler(CountryCommandHandler(lambda command: api.commands.get(command), country))
     # set country (this has to be added before the free text handler)
     dp.add_handler(ConversationHandler(
         entry_points=[CommandHandler("setcountry", handle_setcountry_start)],
@@ -621,19 +854,70 @@ def main(config):
     # subscription
     dp.add_handler(CommandHandler("subscribe", command_subscribe))
     dp.add_handler(CommandHandler("unsubscribe", command_unsubscribe))
-    # subscription job
     job_queue = updater.job_queue
+    # chats that did not choose a time are notified at notify_time, or not at all if it is not set
     if 'notify_time' in config:
-        job_queue.run_daily(run_notify, datetime.strptime(config['notify_time'], '%H:%M').time())
+        subscribers.default_slot = slot_of(datetime.strptime(config['notify_time'], '%H:%M').time())
+    subscribers.load(dp.bot_data)
+    map_cache.enabled = config.get('map_cache', False)
+    if worker != 0:
+        job_queue.run_repeating(reload_shared, config.get('reload_interval', 60))
+        broadcaster = None
+    else:
+        # subscription job
+        broadcaster = Broadcaster(updater.bot,
+                workers=config.get('broadcast_workers', 8), rate=config.get('broadcast_rate', 25),
+                on_forbidden=subscribers.unsubscribe)
+        first_wave = next_slot_start(datetime.utcnow())
+        job_queue.run_repeating(run_notify, SLOT_MINUTES * 60, first=first_wave, context=broadcaster)
+        # the other workers change subscriptions, so load them again shortly before every wave
+        if shared and hasattr(persistence, 'reload_bot_data'):
+            job_queue.run_repeating(lambda context: reload_subscribers(persistence, dp.bot_data),
+                    SLOT_MINUTES * 60, first=first_wave - timedelta(seconds=30))
+        # poll the bulk endpoints, so the handlers answer from memory
+        prefetch_interval = config.get('prefetch_interval', 120)
+        if prefetch_interval:
+            top = config.get('prerender_top', 0)
+            on_update = (lambda changed: prerender_plots(top)) if top else None
+            prefetcher = Prefetcher(api, orders=SORT_ORDERS, on_update=on_update)
+            job_queue.run_repeating(prefetcher.run, prefetch_interval, first=0)
+        # keep the local time series of all countries up to date, graphs are rendered from them
+        job_queue.run_repeating(lambda context: api.update_timeseries(), config.get('timeseries_interval', 6 * 3600),
+                first=1)
+        # keep local copies of the maps, instead of letting Telegram download them every hour
+        if map_cache.enabled:
+            job_queue.run_repeating(lambda context: map_cache.refresh(), config.get('map_refresh_interval', 6 * 3600))
+        # archive inactive users at night, if the persistence supports it
+        if hasattr(persistence, 'compact'):
+            max_inactive_days = config.get('archive_after_days', 180)
+            job_queue.run_daily(lambda context: persistence.compact(max_inactive_days), time(hour=4))
+        # continue a broadcast that was interrupted by a restart
+        broadcaster.resume()
     # free text input
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_text))
-    dp.add_handler(InlineQueryHandler(handle_inlinequery))
+    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, text))
+    dp.add_handler(InlineQueryHandler(inline))
     dp.add_error_handler(error)
-    # start the bot
+
+    def shutdown():
+        if broadcaster:
+            api.save_last_good()
+            broadcaster.stop()
+        stop_event_loop()
+        renderer.shutdown()
+    return updater, shutdown
+
+def main(config, use_webhook=False):
+    if use_webhook:
+        # the HTTP server is only imported in webhook mode, so starting in polling mode stays fast
+        import webhook
+        webhook.serve(config, setup)
+        return
+    updater, shutdown = setup(config)
     updater.start_polling()
     updater.idle()
+    shutdown()
 
 if __name__ == "__main__":
     with open(CONFIG_FILE, 'r') as f:
         config = json.load(f)
-    main(config)
+    main(config, use_webhook="--webhook" in sys.argv[1:])
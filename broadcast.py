@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from telegram import ParseMode
+from telegram.error import RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    # stop handing out tokens for a while, e.g. when Telegram asks us to back off
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            # the tokens are refilled from the end of the pause
+            self.updated = self.paused_until
+
+
+class Broadcaster:
+    """Sends pre-rendered messages to many chats from a pool of worker threads.
+
+    Sending is limited by a global token bucket and a minimal interval per chat, and `RetryAfter` errors pause
+    all workers before the message is retried. The pending recipients of every broadcast are checkpointed to
+    `checkpoint_file`, so a broadcast that was interrupted by a restart is resumed instead of sent again.
+    """
+
+    def __init__(self, bot, checkpoint_file="broadcast.json", workers=8, rate=25, per_chat_interval=1.0,
+                 checkpoint_interval=2.0, on_forbidden=None):
+        self.bot = bot
+        self.checkpoint_file = checkpoint_file
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.on_forbidden = on_forbidden
+        # broadcast id -> {"messages": [text], "pending": {chat_id: message index}, "sent": int, "failed": int}
+        self._broadcasts = {}
+        self._last_sent = {}
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._last_checkpoint = 0
+
+    # messages is a list of texts, recipients a list of (chat_id, message index) tuples
+    def start(self, broadcast_id, messages, recipients):
+        with self._lock:
+            if broadcast_id in self._broadcasts:
+                logger.warning("Broadcast {} is already running.".format(broadcast_id))
+                return
+            pending = dict(recipients)
+            self._broadcasts[broadcast_id] = {"messages": messages, "pending": pending, "sent": 0, "failed": 0}
+            self._save_checkpoint()
+        logger.info("Starting broadcast {} to {} chats.".format(broadcast_id, len(pending)))
+        self._enqueue(broadcast_id, pending)
+
+    def resume(self):
+        if not os.path.exists(self.checkpoint_file):
+            return
+        try:
+            with open(self.checkpoint_file, "r") as f:
+                broadcasts = json.load(f)
+        except (OSError, ValueError):
+            logger.error("Failed to read broadcast checkpoint {}".format(self.checkpoint_file), exc_info=True)
+            return
+        for broadcast_id, broadcast in broadcasts.items():
+            # JSON object keys are always strings
+            pending = {int(chat_id): index for chat_id, index in broadcast["pending"].items()}
+            if not pending:
+                continue
+            with self._lock:
+                if broadcast_id in self._broadcasts:
+                    continue
+                self._broadcasts[broadcast_id] = dict(broadcast, pending=pending)
+            logger.info("Resuming broadcast {} to {} remaining chats.".format(broadcast_id, len(pending)))
+            self._enqueue(broadcast_id, pending)
+
+    def stop(self):
+        with self._lock:
+            self._save_checkpoint()
+
+    def _enqueue(self, broadcast_id, pending):
+        for chat_id, index in list(pending.items()):
+            self._queue.put((broadcast_id, chat_id, index))
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _wait_for_chat(self, chat_id):
+        with self._lock:
+            last = self._last_sent.get(chat_id, 0)
+            self._last_sent[chat_id] = max(time.monotonic(), last + self.per_chat_interval)
+        wait = last + self.per_chat_interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def _work(self):
+        while True:
+            broadcast_id, chat_id, index = self._queue.get()
+            try:
+                self._send(broadcast_id, chat_id, index)
+            finally:
+                self._queue.task_done()
+
+    def _send(self, broadcast_id, chat_id, index):
+        broadcast = self._broadcasts[broadcast_id]
+        self._wait_for_chat(chat_id)
+        self.bucket.acquire()
+        try:
+            self.bot.send_message(chat_id=chat_id, text=broadcast["messages"][index], parse_mode=ParseMode.MARKDOWN)
+            success = True
+        except RetryAfter as ex:
+            logger.warning("Flood control exceeded, pausing broadcast for {} seconds.".format(ex.retry_after))
+            self.bucket.pause(ex.retry_after)
+            self._queue.put((broadcast_id, chat_id, index))
+            return
+        except Exception as ex:
+            # remove user from subscribers if he blocked or kicked the bot
+            if isinstance(ex, TelegramError) and ex.message.startswith("Forbidden: ") and self.on_forbidden:
+                self.on_forbidden(chat_id)
+            logger.error("Failed to send broadcast {} to {}".format(broadcast_id, chat_id), exc_info=True)
+            success = False
+        self._done(broadcast_id, chat_id, success)
+
+    def _done(self, broadcast_id, chat_id, success):
+        with self._lock:
+            broadcast = self._broadcasts[broadcast_id]
+            broadcast["pending"].pop(chat_id, None)
+            broadcast["sent" if success else "failed"] += 1
+            finished = not broadcast["pending"]
+            if finished:
+                del self._broadcasts[broadcast_id]
+                if not self._broadcasts:
+                    self._last_sent.clear()
+            if finished or time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+                self._save_checkpoint()
+        if finished:
+            logger.info("Finished broadcast {}: sent to {} chats, {} failed.".format(
+                broadcast_id, broadcast["sent"], broadcast["failed"]))
+
+    # must be called with the lock held
+    def _save_checkpoint(self):
+        self._last_checkpoint = time.monotonic()
+        if not self._broadcasts:
+            if os.path.exists(self.checkpoint_file):
+                os.remove(self.checkpoint_file)
+            return
+        tmp_file = self.checkpoint_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self._broadcasts, f)
+        os.replace(tmp_file, self.checkpoint_file)
@@ -0,0 +1,117 @@
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """A thread-safe LRU cache whose entries expire after a per-entry TTL.
+
+    Expired entries are kept for another `stale_ttl` seconds. Within that window, `get` returns the stale
+    value right away and refreshes it once in a background thread (stale-while-revalidate).
+    """
+
+    def __init__(self, max_size=512, stale_ttl=600):
+        self.max_size = max_size
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        # key -> [value, expiry time, refresh running]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, loader, ttl):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                value, expires, refreshing = entry
+                if now < expires:
+                    self.hits += 1
+                    return value
+                if now < expires + self.stale_ttl:
+                    self.stale_hits += 1
+                    if not refreshing:
+                        entry[2] = True
+                        threading.Thread(target=self._refresh, args=(key, loader, ttl), daemon=True).start()
+                    return value
+            self.misses += 1
+        value = loader()
+        if value is not None:
+            self.put(key, value, ttl)
+        return value
+
+    def put(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = [value, time.monotonic() + ttl, False]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def _refresh(self, key, loader, ttl):
+        try:
+            value = loader()
+        except Exception:
+            logger.warning("Failed to refresh cache entry {}".format(key), exc_info=True)
+            value = None
+        if value is not None:
+            self.put(key, value, ttl)
+        else:
+            # keep serving the stale value and try again on the next request
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry:
+                    entry[2] = False
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key, so only one of them runs and all of them get its result.
+
+    `calls` counts the calls that ran, `coalesced` the calls that waited for a running call instead.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        # key -> [done event, result, exception]
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight:
+                self.coalesced += 1
+            else:
+                self.calls += 1
+                self._flights[key] = [threading.Event(), None, None]
+        if flight:
+            flight[0].wait()
+            if flight[2] is not None:
+                raise flight[2]
+            return flight[1]
+        flight = self._flights[key]
+        try:
+            flight[1] = function()
+            return flight[1]
+        except Exception as ex:
+            flight[2] = ex
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight[0].set()
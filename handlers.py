@@ -0,0 +1,38 @@
+from telegram import MessageEntity, Update
+from telegram.ext import Handler
+
+
+class CountryCommandHandler(Handler):
+    """Handles the commands of all countries, e.g. /ke, /ken and /kenya, with a single dict lookup.
+
+    `lookup` maps the lowercase command to a country code or returns None, the callback is called with the
+    update, the context and the country code. Registering one CommandHandler per command instead would make the
+    dispatcher test hundreds of handlers for every update.
+    """
+
+    def __init__(self, lookup, callback):
+        super().__init__(callback)
+        self.lookup = lookup
+
+    def check_update(self, update):
+        # like CommandHandler, only messages and edited messages, no channel posts
+        if not isinstance(update, Update) or not (update.message or update.edited_message):
+            return None
+        message = update.message or update.edited_message
+        if not (message.entities and message.entities[0].type == MessageEntity.BOT_COMMAND
+                and message.entities[0].offset == 0 and message.text and message.bot):
+            return None
+        command, _, username = message.text[1:message.entities[0].length].partition('@')
+        if username and username.lower() != message.bot.username.lower():
+            return None
+        country_code = self.lookup(command.lower())
+        if country_code is None:
+            return None
+        return message.text.split()[1:], country_code
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        self.collect_additional_context(context, update, dispatcher, check_result)
+        return self.callback(update, context, check_result[1])
+
+    def collect_additional_context(self, context, update, dispatcher, check_result):
+        context.args = check_result[0]
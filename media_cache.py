@@ -0,0 +1,219 @@
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import requests
+
+import transport
+
+logger = logging.getLogger(__name__)
+
+
+def _file_name(key):
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".png"
+
+
+class ImageCache:
+    """An LRU cache for rendered images, holding at most `max_memory` bytes in memory.
+
+    Images evicted from memory are spilled to `directory` (if given), which keeps at most `max_disk_files`
+    files, and are promoted back to memory when requested again. With `write_through`, every image is written
+    to disk right away, so the cache survives restarts.
+    """
+
+    def __init__(self, max_memory=32 * 1024 * 1024, directory=None, max_disk_files=1000, write_through=False):
+        self.max_memory = max_memory
+        self.directory = directory
+        self.max_disk_files = max_disk_files
+        self.write_through = write_through
+        self.memory_size = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                return self._images[key]
+        if not self.directory:
+            return None
+        path = os.path.join(self.directory, _file_name(key))
+        try:
+            with open(path, "rb") as f:
+                image = f.read()
+        except OSError:
+            return None
+        self.put(key, image, on_disk=True)
+        return image
+
+    # `on_disk` means the image was read from disk, so only the images it evicts have to be written
+    def put(self, key, image, on_disk=False):
+        evicted = []
+        with self._lock:
+            if key in self._images:
+                self.memory_size -= len(self._images.pop(key))
+            self._images[key] = image
+            self.memory_size += len(image)
+            while self.memory_size > self.max_memory and len(self._images) > 1:
+                old_key, old_image = self._images.popitem(last=False)
+                self.memory_size -= len(old_image)
+                evicted.append((old_key, old_image))
+        if self.directory:
+            if self.write_through:
+                if not on_disk:
+                    self._write(key, image)
+            else:
+                for old_key, old_image in evicted:
+                    self._write(old_key, old_image)
+
+    # drops the images in memory, e.g. because another process replaced the files
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.memory_size = 0
+
+    def _write(self, key, image):
+        path = os.path.join(self.directory, _file_name(key))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # the directory may be shared by several processes, each of them writes its own temporary file
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                f.write(image)
+            os.replace(tmp_path, path)
+            files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".png")]
+            if len(files) > self.max_disk_files:
+                files.sort(key=os.path.getmtime)
+                for old_path in files[:len(files) - self.max_disk_files]:
+                    os.remove(old_path)
+        except OSError:
+            logger.warning("Failed to spill image to {}".format(path), exc_info=True)
+
+
+class FileIdCache:
+    """Remembers the Telegram file_id of uploaded images, so they can be sent again without uploading."""
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._ids:
+                self._ids.move_to_end(key)
+                return self._ids[key]
+            return None
+
+    def put(self, key, file_id):
+        with self._lock:
+            self._ids[key] = file_id
+            self._ids.move_to_end(key)
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._ids.pop(key, None)
+
+
+class MapCache:
+    """Local copies of the map images, so Telegram does not have to download them from Wikimedia.
+
+    The images are kept in an on-disk ImageCache, together with their ETag and Last-Modified validators in
+    index.json. `refresh` revalidates all of them with conditional requests, so unchanged maps are not
+    downloaded again.
+    """
+
+    def __init__(self, directory="cache/maps", max_files=500, client=None):
+        self.directory = directory
+        self.images = ImageCache(max_memory=8 * 1024 * 1024, directory=directory, max_disk_files=max_files,
+                                 write_through=True)
+        self.client = client or transport.client
+        self.enabled = False
+        # url -> (etag, last modified)
+        self._validators = None
+        self._lock = threading.Lock()
+
+    def _index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    def _load_validators(self):
+        if self._validators is None:
+            try:
+                with open(self._index_path(), "r") as f:
+                    self._validators = {url: tuple(validator) for url, validator in json.load(f).items()}
+            except (OSError, ValueError):
+                self._validators = {}
+        return self._validators
+
+    def _save_validators(self):
+        path = self._index_path()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump(self._validators, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.warning("Failed to save the map validators to {}".format(path), exc_info=True)
+
+    # Downloads a map, conditionally if it is cached already. Returns the image or None if the download failed.
+    def _download(self, url, cached=None):
+        headers = {}
+        with self._lock:
+            validator = self._load_validators().get(url)
+        if cached is not None and validator:
+            etag, last_modified = validator
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        try:
+            response = self.client.get(url, headers=headers)
+        except requests.RequestException as ex:
+            logger.warning("Download of {} failed: {}".format(url, ex))
+            return cached
+        if response.status_code == 304:
+            return cached
+        if response.status_code != 200:
+            logger.warning("Download of {} failed with status {}".format(url, response.status_code))
+            return cached
+        image = response.content
+        self.images.put(url, image)
+        with self._lock:
+            # read the index again, other processes sharing the directory may have added maps
+            self._validators = None
+            self._load_validators()[url] = (response.headers.get("ETag"), response.headers.get("Last-Modified"))
+            self._save_validators()
+        return image
+
+    def get(self, url):
+        image = self.images.get(url)
+        if image is None:
+            image = self._download(url)
+        return image
+
+    # loads the maps and their validators from disk again, after another process refreshed them
+    def reload(self):
+        with self._lock:
+            self._validators = None
+        self.images.clear()
+
+    # revalidates all maps that were requested before
+    def refresh(self):
+        self.reload()
+        with self._lock:
+            urls = list(self._load_validators())
+        for url in urls:
+            cached = self.images.get(url)
+            if cached is None:
+                # the image was removed from the bounded cache, so forget it until it is requested again
+                with self._lock:
+                    self._validators.pop(url, None)
+                    self._save_validators()
+            else:
+                self._download(url, cached)
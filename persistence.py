@@ -0,0 +1,446 @@
+from collections import defaultdict, OrderedDict
+from datetime import datetime
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from telegram.ext import BasePersistence, PicklePersistence
+
+import subscribers
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindPersistence(PicklePersistence):
+    """A PicklePersistence that writes changes in the background instead of on every update.
+
+    Changed user, chat and bot data entries are tracked as dirty. They are written together every `interval`
+    seconds or as soon as `max_dirty` entries changed, whichever comes first. Files are replaced atomically
+    via a temporary file, and `flush` (which the updater calls on shutdown) writes immediately.
+    """
+
+    write_behind = True
+
+    def __init__(self, filename, interval=30, max_dirty=500, **kwargs):
+        kwargs["on_flush"] = True
+        super().__init__(filename, **kwargs)
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self.writes = 0
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+        self._thread.start()
+
+    # The stored data never contains Bot instances, so a pickle round trip copies it much faster than the
+    # generic object traversal of BasePersistence.
+    @classmethod
+    def replace_bot(cls, obj):
+        return pickle.loads(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    def insert_bot(self, obj):
+        return pickle.loads(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    @property
+    def dirty_count(self):
+        return len(self._dirty)
+
+    # must be called with the lock held
+    def _mark_dirty(self, key):
+        self._dirty.add(key)
+        if len(self._dirty) >= self.max_dirty:
+            self._wakeup.set()
+
+    def update_user_data(self, user_id, data):
+        with self._lock:
+            if self.user_data is None or self.user_data.get(user_id) != data:
+                super().update_user_data(user_id, data)
+                self._mark_dirty(("user_data", user_id))
+
+    def update_chat_data(self, chat_id, data):
+        with self._lock:
+            if self.chat_data is None or self.chat_data.get(chat_id) != data:
+                super().update_chat_data(chat_id, data)
+                self._mark_dirty(("chat_data", chat_id))
+
+    def update_bot_data(self, data):
+        with self._lock:
+            if self.bot_data != data:
+                super().update_bot_data(data)
+                self._mark_dirty(("bot_data",))
+
+    def update_conversation(self, name, key, new_state):
+        with self._lock:
+            if not self.conversations or self.conversations.get(name, {}).get(key) != new_state:
+                super().update_conversation(name, key, new_state)
+                self._mark_dirty(("conversations", name))
+
+    def update_callback_data(self, data):
+        with self._lock:
+            if self.callback_data != data:
+                super().update_callback_data(data)
+                self._mark_dirty(("callback_data",))
+
+    def flush(self):
+        with self._write_lock:
+            # Take shallow copies while holding the lock, so the dicts cannot change while they are pickled. The
+            # entries themselves are replaced on every update, never modified.
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                self._wakeup.clear()
+                if not dirty:
+                    return
+                data = {
+                    'conversations': {name: dict(states) for name, states in (self.conversations or {}).items()},
+                    'user_data': self.user_data.copy() if self.user_data is not None else None,
+                    'chat_data': self.chat_data.copy() if self.chat_data is not None else None,
+                    'bot_data': self.bot_data,
+                    'callback_data': self.callback_data,
+                }
+            try:
+                if self.single_file:
+                    self._dump_file(self.filename, data)
+                else:
+                    # only rewrite the files with changed entries
+                    for kind in {key[0] for key in dirty}:
+                        self._dump_file("{}_{}".format(self.filename, kind), data[kind])
+            except Exception:
+                # try again with the next flush
+                with self._lock:
+                    self._dirty |= dirty
+                raise
+            self.writes += 1
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.error("Failed to write persistence file {}".format(self.filename), exc_info=True)
+
+    @staticmethod
+    def _dump_file(filename, data):
+        # write to a temporary file first, so a crash while writing never leaves a truncated file behind
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as file:
+            pickle.dump(data, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filename, filename)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL, last_acc REAL);
+CREATE INDEX IF NOT EXISTS users_last_acc ON users (last_acc);
+CREATE TABLE IF NOT EXISTS archived_users (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL, last_acc REAL, archived REAL);
+CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL, country TEXT);
+CREATE INDEX IF NOT EXISTS chats_country ON chats (country);
+CREATE TABLE IF NOT EXISTS subscribers (chat_id INTEGER PRIMARY KEY, lang TEXT, slot INTEGER);
+CREATE TABLE IF NOT EXISTS bot_data (key TEXT PRIMARY KEY, value BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key BLOB NOT NULL, state BLOB NOT NULL, PRIMARY KEY (name, key));
+"""
+
+
+class LazyStore(defaultdict):
+    """The user_data or chat_data of the dispatcher, loading entries from the database when they are accessed.
+
+    At most `max_size` entries are kept in memory. The least recently used ones are dropped, but only after
+    they were not accessed for `min_idle` seconds, so no handler is still working with them. `on_evict` is called
+    with the key of every dropped entry.
+    """
+
+    def __init__(self, load, max_size=10000, min_idle=300, on_evict=None):
+        super().__init__(dict)
+        self._load = load
+        self._on_evict = on_evict
+        self.max_size = max_size
+        self.min_idle = min_idle
+        self._accessed = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = super().__getitem__(key)
+            self._accessed[key] = time.monotonic()
+            self._accessed.move_to_end(key)
+            return value
+
+    def __missing__(self, key):
+        value = self._load(key)
+        self[key] = value
+        self._evict()
+        return value
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    def discard(self, key):
+        with self._lock:
+            self.pop(key, None)
+            self._accessed.pop(key, None)
+
+    def _evict(self):
+        now = time.monotonic()
+        while len(self._accessed) > self.max_size:
+            key, accessed = next(iter(self._accessed.items()))
+            if now - accessed < self.min_idle:
+                break
+            self.discard(key)
+            if self._on_evict:
+                self._on_evict(key)
+
+
+class SqlitePersistence(BasePersistence):
+    """Stores user, chat and bot data in an SQLite database in WAL mode.
+
+    User and chat data are only loaded when they are accessed (see `LazyStore`) and every update writes just
+    the changed row. Subscribers and home countries live in indexed tables. If the database is new, the data of
+    the PicklePersistence file `migrate_from` is imported once. `compact` moves users who have been inactive
+    for a while to an archive table, they are restored on their next message.
+    """
+
+    def __init__(self, filename, migrate_from=None, cache_size=10000):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=True)
+        self.filename = filename
+        self.cache_size = cache_size
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        # databases of older versions only stored the chat ids of the subscribers
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(subscribers)")]
+        for column, column_type in (("lang", "TEXT"), ("slot", "INTEGER")):
+            if column not in columns:
+                self._db.execute("ALTER TABLE subscribers ADD COLUMN {} {}".format(column, column_type))
+        # hashes of the rows as last written, to skip writing unchanged data
+        self._written = {}
+        # the subscribers as last written and the version of them, see subscribers.SubscriberRegistry
+        self._subscribers = {}
+        self._subscribers_version = None
+        # set if several processes share the database, see refresh_user_data
+        self.shared = False
+        self.user_data = None
+        self.chat_data = None
+        self.bot_data = None
+        if migrate_from and os.path.exists(migrate_from) and not self._meta("migrated"):
+            self.migrate_pickle(migrate_from)
+
+    # The stored data never contains Bot instances, and it is serialized right away, so there is no need to
+    # copy it. Copying would also break the lazy loading of the stores.
+    @classmethod
+    def replace_bot(cls, obj):
+        return obj
+
+    def insert_bot(self, obj):
+        return obj
+
+    def _meta(self, key, value=None):
+        with self._lock:
+            if value is None:
+                row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+                return row[0] if row else None
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _changed(self, key, blob):
+        digest = hash(blob)
+        if self._written.get(key) == digest:
+            return False
+        self._written[key] = digest
+        return True
+
+    def migrate_pickle(self, filename):
+        with open(filename, "rb") as f:
+            data = pickle.load(f)
+        with self._lock:
+            self._db.execute("BEGIN")
+            for user_id, user_data in data.get('user_data', {}).items():
+                self._write_user(user_id, user_data)
+            for chat_id, chat_data in data.get('chat_data', {}).items():
+                self._write_chat(chat_id, chat_data)
+            self._write_bot_data(data.get('bot_data', {}))
+            for name, states in data.get('conversations', {}).items():
+                for key, state in states.items():
+                    self._write_conversation(name, key, state)
+            self._meta("migrated", "{}@{}".format(filename, datetime.utcnow().isoformat()))
+            self._db.execute("COMMIT")
+        logger.info("Migrated {} users and {} chats from {}".format(
+            len(data.get('user_data', {})), len(data.get('chat_data', {})), filename))
+
+    def _load_user(self, user_id):
+        with self._lock:
+            row = self._db.execute("SELECT data FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                # restore archived users when they come back
+                row = self._db.execute("SELECT data FROM archived_users WHERE user_id = ?", (user_id,)).fetchone()
+                if row:
+                    self._db.execute("DELETE FROM archived_users WHERE user_id = ?", (user_id,))
+                    self._write_user(user_id, pickle.loads(row[0]))
+        return pickle.loads(row[0]) if row else {}
+
+    def _load_chat(self, chat_id):
+        with self._lock:
+            row = self._db.execute("SELECT data FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        return pickle.loads(row[0]) if row else {}
+
+    def get_user_data(self):
+        if self.user_data is None:
+            self.user_data = LazyStore(self._load_user, max_size=self.cache_size,
+                                       on_evict=lambda user_id: self._forget(("user", user_id)))
+        return self.user_data
+
+    def get_chat_data(self):
+        if self.chat_data is None:
+            self.chat_data = LazyStore(self._load_chat, max_size=self.cache_size,
+                                       on_evict=lambda chat_id: self._forget(("chat", chat_id)))
+        return self.chat_data
+
+    # Drops the hash of a row that is no longer cached, so the hashes take no more memory than the cache. It is
+    # called by the store while it holds its own lock, so it must not take the lock of the persistence.
+    def _forget(self, key):
+        self._written.pop(key, None)
+
+    def _read_bot_data(self):
+        with self._lock:
+            rows = self._db.execute("SELECT key, value FROM bot_data").fetchall()
+            data = {key: pickle.loads(value) for key, value in rows}
+            rows = self._db.execute("SELECT chat_id, lang, slot FROM subscribers")
+            self._subscribers = {chat_id: (lang, slot) for chat_id, lang, slot in rows}
+            self._subscribers_version = data.get('subscribers_version')
+        if self._subscribers:
+            data['subscribers'] = dict(self._subscribers)
+        return data
+
+    def get_bot_data(self):
+        if self.bot_data is None:
+            self.bot_data = self._read_bot_data()
+        return self.bot_data
+
+    # Loads the bot data again, e.g. the subscriptions made by other processes sharing the database. The dict
+    # of the dispatcher is updated in place.
+    def reload_bot_data(self):
+        data = self._read_bot_data()
+        self.get_bot_data().clear()
+        self.bot_data.update(data)
+
+    # Called by the dispatcher before it handles an update. The processes sharing the database handle the updates
+    # of different chats, but a user can write in several of them, e.g. in a group and a private chat. So the user
+    # data is read again and the changes of the other processes are not overwritten.
+    def refresh_user_data(self, user_id, user_data):
+        if self.shared:
+            data = self._load_user(user_id)
+            user_data.clear()
+            user_data.update(data)
+
+    # the chat data as stored in the database, e.g. of a chat handled by another process sharing it
+    def load_chat_data(self, chat_id):
+        return self._load_chat(chat_id)
+
+    def get_conversations(self, name):
+        with self._lock:
+            rows = self._db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {pickle.loads(key): pickle.loads(state) for key, state in rows}
+
+    def _write_user(self, user_id, data):
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        if self._changed(("user", user_id), blob):
+            self._db.execute("INSERT OR REPLACE INTO users (user_id, data, last_acc) VALUES (?, ?, ?)",
+                             (user_id, blob, data.get('last_acc')))
+
+    def _write_chat(self, chat_id, data):
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        if self._changed(("chat", chat_id), blob):
+            self._db.execute("INSERT OR REPLACE INTO chats (chat_id, data, country) VALUES (?, ?, ?)",
+                             (chat_id, blob, data.get('country')))
+
+    def _write_bot_data(self, data):
+        new = subscribers.normalize(data.get('subscribers', {}))
+        version = data.get('subscribers_version')
+        # the registry counts its changes, so the subscribers only have to be compared without a version
+        if (version != self._subscribers_version or version is None) and new != self._subscribers:
+            old = self._subscribers
+            self._db.executemany("DELETE FROM subscribers WHERE chat_id = ?", [(c,) for c in old if c not in new])
+            self._db.executemany("INSERT OR REPLACE INTO subscribers (chat_id, lang, slot) VALUES (?, ?, ?)",
+                                 [(c,) + entry for c, entry in new.items() if old.get(c) != entry])
+            self._subscribers = dict(new)
+        self._subscribers_version = version
+        for key, value in data.items():
+            if key == 'subscribers':
+                continue
+            blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            if self._changed(("bot", key), blob):
+                self._db.execute("INSERT OR REPLACE INTO bot_data (key, value) VALUES (?, ?)", (key, blob))
+
+    def _write_conversation(self, name, key, state):
+        key = pickle.dumps(key, pickle.HIGHEST_PROTOCOL)
+        if state is None:
+            self._db.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+        else:
+            self._db.execute("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                             (name, key, pickle.dumps(state, pickle.HIGHEST_PROTOCOL)))
+
+    def update_user_data(self, user_id, data):
+        with self._lock:
+            self._write_user(user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        with self._lock:
+            self._write_chat(chat_id, data)
+
+    def update_bot_data(self, data):
+        with self._lock:
+            self._write_bot_data(data)
+
+    def update_conversation(self, name, key, new_state):
+        with self._lock:
+            self._write_conversation(name, key, new_state)
+
+    # every update is committed right away, SQLite checkpoints the WAL by itself
+    def flush(self):
+        pass
+
+    # moves users who have not been active for the given number of days to the archive
+    def compact(self, max_inactive_days):
+        now = datetime.now().timestamp()
+        threshold = now - max_inactive_days * 24 * 3600
+        with self._lock:
+            user_ids = [row[0] for row in self._db.execute(
+                "SELECT user_id FROM users WHERE last_acc IS NOT NULL AND last_acc < ?", (threshold,))]
+            self._db.execute("BEGIN")
+            self._db.execute("""INSERT OR REPLACE INTO archived_users (user_id, data, last_acc, archived)
+                SELECT user_id, data, last_acc, ? FROM users WHERE last_acc IS NOT NULL AND last_acc < ?""",
+                (now, threshold))
+            self._db.execute("DELETE FROM users WHERE last_acc IS NOT NULL AND last_acc < ?", (threshold,))
+            self._db.execute("COMMIT")
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        # the store takes the lock of the persistence to load users, so it is discarded from without holding it
+        for user_id in user_ids:
+            self._forget(("user", user_id))
+            if self.user_data is not None:
+                self.user_data.discard(user_id)
+        logger.info("Archived {} users inactive for more than {} days.".format(len(user_ids), max_inactive_days))
+        return len(user_ids)
+
+
+# creates the persistence selected by the 'persistence' option of the config
+def make_persistence(config):
+    mode = config.get('persistence', "pickle")
+    if mode == "sqlite":
+        # the pickle file of the other modes is migrated on the first start
+        return SqlitePersistence(config.get('database', "database.sqlite"),
+                migrate_from="database.pkl", cache_size=config.get('persistence_cache_size', 10000))
+    filename = config.get('database', "database.pkl")
+    if mode == "write_behind":
+        return WriteBehindPersistence(filename,
+                interval=config.get('persistence_interval', 30), max_dirty=config.get('persistence_max_dirty', 500))
+    elif mode == "pickle":
+        return PicklePersistence(filename)
+    else:
+        raise ValueError("Unknown persistence {}".format(mode))
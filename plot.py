@@ -1,69 +1,79 @@
 import io
 from datetime import timedelta
 
-import numpy as np
 import matplotlib
-import matplotlib.pyplot as plt
+import matplotlib.style
+from matplotlib.figure import Figure
 from matplotlib.ticker import StrMethodFormatter
 
+from analytics import moving_average
+
 
 matplotlib.use("Agg")
-matplotlib.style.use("seaborn")
+# the seaborn style was renamed in matplotlib 3.6 and the old name removed in 3.8
+matplotlib.style.use("seaborn-v0_8" if "seaborn-v0_8" in matplotlib.style.available else "seaborn")
 
+# The plots are drawn with the object-oriented API instead of the pyplot state machine. Every call creates and
+# releases its own figure, so concurrent calls cannot draw into each other's figures or leak them.
 
-def _moving_avg(data, days=7):
-    # Use 1d convolution for moving average, as explained in https://stackoverflow.com/a/22621523.
-    return np.convolve(data, np.ones(days) / days, mode="valid")
+
+def _save(fig):
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    buffer.seek(0)
+    return buffer
 
 
 def plot_timeseries(data):
-    fig, ax = plt.subplots()
+    fig = Figure(figsize=(13, 8))
+    ax = fig.subplots()
     ax.yaxis.set_major_formatter(StrMethodFormatter("{x:,.0f}"))
-    cases, deaths = _moving_avg(data["cases"]), _moving_avg(data["deaths"])
+    cases, deaths = moving_average(data["cases"]), moving_average(data["deaths"])
     dates = [data["last_date"] - timedelta(days=i) for i in range(len(cases))][::-1]
-    plt.figure(figsize=(13, 8))
-    plt.plot(dates, cases, ".-c", label="Infections")
-    plt.fill_between(dates, cases, color="c", alpha=0.5)
-    plt.plot(dates, deaths, ".-r", label="Deaths")
-    plt.fill_between(dates, deaths, color="r", alpha=0.5)
-    plt.annotate(round(cases[-1]), (dates[-1], cases[-1]), ha="right", va="bottom", color="c")
-    plt.annotate(round(deaths[-1]), (dates[-1], deaths[-1]), ha="right", va="bottom", color="r")
-    plt.legend()
-    plt.xticks(rotation=30, ha="right")
-    plt.xlim((dates[0], dates[-1]))
-    plt.ylabel("Cases (moving 7-day avg.)")
-    plt.title("New Covid-19 Cases in {} - {} Days".format(data["name"], len(cases)))
-    plt.text(0, 0, "by @coronaviruskenyabot; data by JHUCSSE", fontsize=6, va="bottom", transform=ax.transAxes)
-    plt.tight_layout()
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format="png")
-    buffer.seek(0)
-    plt.clf()
-    return buffer
+    ax.plot(dates, cases, ".-c", label="Infections")
+    ax.fill_between(dates, cases, color="c", alpha=0.5)
+    ax.plot(dates, deaths, ".-r", label="Deaths")
+    ax.fill_between(dates, deaths, color="r", alpha=0.5)
+    ax.annotate(round(cases[-1]), (dates[-1], cases[-1]), ha="right", va="bottom", color="c")
+    ax.annotate(round(deaths[-1]), (dates[-1], deaths[-1]), ha="right", va="bottom", color="r")
+    ax.legend()
+    ax.tick_params(axis="x", labelrotation=30)
+    for label in ax.get_xticklabels():
+        label.set_horizontalalignment("right")
+    ax.set_xlim((dates[0], dates[-1]))
+    ax.set_ylabel("Cases (moving 7-day avg.)")
+    ax.set_title("New Covid-19 Cases in {} - {} Days".format(data["name"], len(cases)))
+    ax.text(0, 0, "by @coronaviruskenyabot; data by JHUCSSE", fontsize=6, va="bottom", transform=ax.transAxes)
+    fig.tight_layout()
+    return _save(fig)
 
 
 def plot_vaccinations_series(data):
-    fig, ax = plt.subplots()
+    fig = Figure(figsize=(13, 8))
+    ax = fig.subplots()
     ax.yaxis.set_major_formatter(StrMethodFormatter("{x:,.0f}"))
-    vaccinations = _moving_avg(data["vaccinations"])
+    vaccinations = moving_average(data["vaccinations"])
     dates = [data["last_date"] - timedelta(days=i) for i in range(len(vaccinations))][::-1]
-    plt.figure(figsize=(13, 8))
-    plt.plot(dates, vaccinations, ".-g")
-    plt.fill_between(dates, vaccinations, color="g", alpha=0.5)
-    plt.xticks(rotation=30, ha="right")
-    plt.xlim((dates[0], dates[-1]))
-    plt.ylabel("Vaccinations Doses (moving 7-day avg.)")
-    plt.title("Daily Vaccination Doses in {} - {} Days".format(data["name"], len(vaccinations)))
-    plt.text(0.01, 0.95, f"Total: {data['total']:,}", weight="bold", transform=ax.transAxes)
-    plt.text(
+    ax.plot(dates, vaccinations, ".-g")
+    ax.fill_between(dates, vaccinations, color="g", alpha=0.5)
+    ax.tick_params(axis="x", labelrotation=30)
+    for label in ax.get_xticklabels():
+        label.set_horizontalalignment("right")
+    ax.set_xlim((dates[0], dates[-1]))
+    ax.set_ylabel("Vaccinations Doses (moving 7-day avg.)")
+    ax.set_title("Daily Vaccination Doses in {} - {} Days".format(data["name"], len(vaccinations)))
+    ax.text(0.01, 0.95, f"Total: {data['total']:,}", weight="bold", transform=ax.transAxes)
+    ax.text(
         0, 0, "by @coronaviruskenyabot; data by ourworldindata.org.", fontsize=6, va="bottom", transform=ax.transAxes
     )
-    plt.tight_layout()
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format="png")
-    buffer.seek(0)
-    plt.clf()
-    return buffer
+    fig.tight_layout()
+    return _save(fig)
+
+
+PLOTTERS = {
+    "cases": plot_timeseries,
+    "vacc": plot_vaccinations_series,
+}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# the bulk endpoints (and their params) that all requests of the bot are answered from
+ENDPOINTS = [
+    ("all", None),
+    ("countries", None),
+    ("states", None),
+    ("gov/de", None),
+    ("vaccine/coverage", {"lastdays": 1}),
+    ("vaccine/coverage/countries", {"lastdays": 2}),
+]
+
+
+# The newest `updated` timestamp of a payload. Payloads without one, like the vaccinations, are compared as a
+# whole.
+def _version(data):
+    if isinstance(data, dict) and "updated" in data:
+        return data["updated"]
+    elif isinstance(data, list) and data and all(isinstance(item, dict) and "updated" in item for item in data):
+        return max(item["updated"] for item in data)
+    else:
+        return data
+
+
+class Prefetcher:
+    """Polls the bulk endpoints of the API in a job of the job queue and keeps them in the cache of CovidApi.
+
+    The polling interval is shorter than the TTLs of the cache, so handlers never wait for the network. When the
+    `updated` timestamp of an endpoint advances, the tables derived from the payloads are rebuilt right away, the
+    last good responses are saved and `on_update` is called with the changed paths, e.g. to pre-render charts.
+    """
+
+    def __init__(self, api, endpoints=ENDPOINTS, orders=(), on_update=None):
+        self.api = api
+        self.endpoints = endpoints
+        self.orders = orders
+        self.on_update = on_update
+        self.polls = 0
+        self.updates = 0
+        # path -> version of the last payload
+        self._versions = {}
+
+    def run(self, context=None):
+        changed = []
+        for path, params in self.endpoints:
+            data = self.api.prefetch(path, params)
+            if data is None:
+                continue
+            version = _version(data)
+            if self._versions.get(path) != version:
+                self._versions[path] = version
+                changed.append(path)
+        self.polls += 1
+        if not changed:
+            return changed
+        self.updates += 1
+        self.api.warm(self.orders)
+        if self.api.last_good_file:
+            self.api.save_last_good()
+        logger.info("Upstream data of {} was updated.".format(", ".join(changed)))
+        if self.on_update:
+            try:
+                self.on_update(changed)
+            except Exception:
+                logger.exception("Handling the update of {} failed".format(", ".join(changed)))
+        return changed
@@ -0,0 +1,46 @@
+from bisect import bisect_left
+
+# lower values are listed first if several kinds of places match
+KIND_RANKS = {
+    "country": 0,
+    "us_state": 1,
+    "de_state": 2,
+}
+
+
+class PrefixIndex:
+    """A sorted array of lowercase names for fast prefix lookups with bisect.
+
+    Entries are (name, kind, value) tuples, e.g. ("germany", "country", "DE"). `search` returns the best `k`
+    matches of distinct places: exact matches first, then by kind and by length of the name.
+    """
+
+    def __init__(self, entries):
+        self._entries = sorted((name.lower(), kind, value) for name, kind, value in entries)
+        self._names = [entry[0] for entry in self._entries]
+        self._ranks = [(KIND_RANKS.get(kind, len(KIND_RANKS)), len(name), name) for name, kind, _ in self._entries]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def search(self, prefix, k=3):
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+        lo = bisect_left(self._names, prefix)
+        hi = bisect_left(self._names, prefix + "\uffff", lo)
+        ranked = sorted(range(lo, hi), key=self._ranks.__getitem__)
+        # an exact match is always the first name of the range
+        if lo < hi and self._names[lo] == prefix:
+            ranked.remove(lo)
+            ranked.insert(0, lo)
+        results, seen = [], set()
+        for i in ranked:
+            name, kind, value = self._entries[i]
+            if (kind, value) in seen:
+                continue
+            seen.add((kind, value))
+            results.append((name, kind, value))
+            if len(results) >= k:
+                break
+        return results
@@ -0,0 +1,61 @@
+from array import array
+import math
+import threading
+
+
+def _valid(value):
+    return isinstance(value, (int, float)) and not math.isnan(value)
+
+
+def _per_hundred(row):
+    if not row.get("population") or not _valid(row.get("vaccinations")):
+        return math.nan
+    return round(row["vaccinations"] / row["population"] * 100, 2)
+
+
+# columns that are computed locally from the joined table
+DERIVED_COLUMNS = {
+    "vaccinationsPerHundred": _per_hundred,
+}
+
+
+class RankingTable:
+    """The list of all countries joined with their vaccination numbers, ranked by any column.
+
+    The ordering of a column is computed once as an index array, so a page of a ranked list is a slice of it.
+    Countries without a value for a column are left out of its ranking.
+    """
+
+    def __init__(self, rows, orders=()):
+        self.rows = rows
+        for row in rows:
+            for column, compute in DERIVED_COLUMNS.items():
+                row[column] = compute(row)
+        self._by_code = {row["countryInfo"]["iso2"]: row for row in rows}
+        self._orders = {}
+        self._lock = threading.Lock()
+        for order in orders:
+            self._ordering(order)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _ordering(self, order):
+        ordering = self._orders.get(order)
+        if ordering is None:
+            indices = [i for i, row in enumerate(self.rows) if _valid(row.get(order))]
+            indices.sort(key=lambda i: self.rows[i][order], reverse=True)
+            ordering = array("I", indices)
+            with self._lock:
+                self._orders[order] = ordering
+        return ordering
+
+    # the row of a country by its iso2 code, or None
+    def get(self, code):
+        return self._by_code.get(code)
+
+    def count(self, order):
+        return len(self._ordering(order))
+
+    def page(self, order, offset, limit):
+        return [self.rows[i] for i in self._ordering(order)[offset:offset + limit]]
@@ -0,0 +1,75 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _render(kind, data):
+    # imported in the worker process only, the bot process itself never needs matplotlib
+    from plot import PLOTTERS
+    buffer = PLOTTERS[kind](data)
+    return buffer.getvalue()
+
+
+def _ready(_):
+    return os.getpid()
+
+
+class RenderService:
+    """Renders charts in a pool of worker processes and returns the PNG bytes.
+
+    Rendering is CPU-bound and holds the GIL, so running it in separate processes lets graph requests use all
+    cores without blocking the dispatcher threads. `data` is the dict returned by `CovidApi.timeseries` or
+    `CovidApi.vaccinations_series`.
+    """
+
+    def __init__(self, workers=None, timeout=30):
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # fork, so the workers do not import and run the bot's main module again
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"))
+            return self._executor
+
+    # start the worker processes right away, preferably before any other threads are running
+    def start(self):
+        list(self._pool().map(_ready, range(self.workers)))
+        logger.info("Started {} render workers.".format(self.workers))
+
+    # Returns None if the chart could not be rendered, e.g. in time.
+    def render(self, kind, data):
+        try:
+            try:
+                return self._pool().submit(_render, kind, data).result(self.timeout)
+            except BrokenProcessPool:
+                # a worker died, e.g. because it was killed, so replace the pool and try once more
+                logger.warning("Render worker pool broke, restarting it.", exc_info=True)
+                self._reset()
+                return self._pool().submit(_render, kind, data).result(self.timeout)
+        except TimeoutError:
+            logger.warning("Rendering the {} chart took longer than {} seconds.".format(kind, self.timeout))
+            return None
+        except Exception:
+            logger.error("Rendering the {} chart failed.".format(kind), exc_info=True)
+            return None
+
+    def _reset(self):
+        with self._lock:
+            if self._executor:
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor:
+                self._executor.shutdown()
+            self._executor = None
@@ -1,25 +1,62 @@
+from collections import OrderedDict
 from datetime import datetime
+import json
+import logging
 import math
+import os
+import re
+import threading
+import time
 
-import requests
+from cache import SingleFlight, TTLCache
+from prefix_index import PrefixIndex
+from ranking import RankingTable
+import transport
 
 
 BASE_URL = "https://disease.sh/v3/covid-19/"
 
+# seconds until a cached response is outdated, by endpoint prefix (the longest matching prefix wins)
+DEFAULT_TTLS = {
+    "": 600,
+    "countries": 600,
+    "states": 600,
+    "gov/": 600,
+    "historical": 1800,
+    "vaccine": 1800,
+}
 
-class CovidApi:
-    """A simple wrapper for the COVID-19 disease.sh API (https://github.com/disease-sh/API)."""
+# regions whose states are served from an in-memory snapshot of one bulk endpoint: region -> (endpoint, name field)
+REGIONS = {
+    "us": ("states", "state"),
+    "de": ("gov/de", "province"),
+}
 
-    def __init__(self):
-        self.countries = self._all_countries()
-        self.name_map = self._build_name_map(self.countries)
-        self.us_states = self._all_us_states()
-        self.de_states = self._all_de_states()
+# large bulk payloads that are revalidated with conditional requests instead of being downloaded again
+CONDITIONAL_PATHS = {"countries", "states", "gov/de", "vaccine/coverage/countries"}
 
-    def _clean(self, s):
-        s = s.replace("\xad", "")
-        s = s.replace("\n", "")
-        return s
+# endpoints whose last good responses are saved to disk, to answer from them if the API is down after a restart
+LAST_GOOD_PATHS = {"all", "countries", "states", "gov/de", "vaccine/coverage", "vaccine/coverage/countries"}
+
+# the format of metadata snapshot files, snapshots of other versions are ignored
+SNAPSHOT_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+class Metadata:
+    """The countries and the state names of all regions, with the lookup tables derived from them.
+
+    A new instance is built for every refresh and swapped in as a whole, so readers never see tables of
+    different versions.
+    """
+
+    def __init__(self, countries, region_states):
+        self.countries = countries
+        self.region_states = region_states
+        self.name_map = self._build_name_map(countries)
+        self.commands = self._build_commands(countries)
+        self.index = self._build_index()
 
     def _build_name_map(self, countries):
         name_map = {}
@@ -29,44 +66,290 @@ class CovidApi:
             name_map[country["name"].lower()] = iso2
         return name_map
 
+    # bot command -> iso2 code, a country can be selected with its iso2 and iso3 codes and its normalized name
+    def _build_commands(self, countries):
+        commands = {}
+        for iso2, country in countries.items():
+            commands[iso2.lower()] = iso2
+            if country["iso3"]:
+                commands[country["iso3"].lower()] = iso2
+            commands[re.sub(r"[^a-z]", "_", country["name"].lower())] = iso2
+        return commands
+
+    # prefix index over all place names for autocompletion
+    def _build_index(self):
+        entries = [(name, "country", iso2) for name, iso2 in self.name_map.items()]
+        for region, states in self.region_states.items():
+            entries += [(state, region + "_state", state) for state in states]
+        return PrefixIndex(entries)
+
+
+class CovidApi:
+    """A simple wrapper for the COVID-19 disease.sh API (https://github.com/disease-sh/API)."""
+
+    def __init__(self, ttls=None, cache_size=512, stale_ttl=600, client=None, snapshot_file=None, timeseries_dir=None,
+                 last_good_file=None, last_good_size=1024):
+        self.client = client or transport.client
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.cache = TTLCache(max_size=cache_size, stale_ttl=stale_ttl)
+        # concurrent requests of the same endpoint share one upstream call
+        self.flights = SingleFlight()
+        # the endpoints that were not cached during a call of `cached`, per thread
+        self._local = threading.local()
+        # key -> (response, time) of the last successful response of every endpoint, served if the API is down
+        self._last_good = OrderedDict()
+        self._last_good_lock = threading.Lock()
+        self.last_good_size = last_good_size
+        self.last_good_file = last_good_file
+        # the time of the last successful response
+        self.last_success = None
+        if last_good_file:
+            self.load_last_good(last_good_file)
+        # region -> (bulk payload, {normalized state name: data}, [state names])
+        self._regions = {}
+        # (countries payload, vaccinations payload, analytics, ranking table)
+        self._ranking = None
+        self.metadata = Metadata({}, {region: [] for region in REGIONS})
+        # the local store of all time series, see update_timeseries
+        self.timeseries_dir = timeseries_dir
+        self._store = None
+        # key of the store -> trend metrics, computed from the store by update_analytics
+        self.analytics = {}
+        self.snapshot_file = snapshot_file
+        # the modification time of the snapshot file when it was loaded by reload
+        self._snapshot_modified = None
+        # without a snapshot file the metadata is fetched right away, otherwise it is loaded from the file and
+        # kept up to date by the thread of start_refresh
+        if snapshot_file is None:
+            self.refresh_metadata()
+        else:
+            self.load_snapshot(snapshot_file)
+
+    countries = property(lambda self: self.metadata.countries)
+    name_map = property(lambda self: self.metadata.name_map)
+    commands = property(lambda self: self.metadata.commands)
+    region_states = property(lambda self: self.metadata.region_states)
+    us_states = property(lambda self: self.metadata.region_states["us"])
+    de_states = property(lambda self: self.metadata.region_states["de"])
+    index = property(lambda self: self.metadata.index)
+
+    # Fetches the countries and states and swaps in the new metadata. Returns False and keeps the current
+    # metadata if the countries could not be fetched, states of regions that failed are kept as well.
+    def refresh_metadata(self):
+        countries = self._all_countries()
+        if not countries:
+            return False
+        region_states = {}
+        for region in REGIONS:
+            region_states[region] = self._region_snapshot(region)[2] or self.metadata.region_states[region]
+        self.metadata = Metadata(countries, region_states)
+        if self.snapshot_file:
+            self.save_snapshot(self.snapshot_file)
+        return True
+
+    def load_snapshot(self, filename):
+        try:
+            with open(filename, "r") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            logger.warning("Could not load the metadata snapshot {}".format(filename))
+            return False
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            logger.info("Ignoring the metadata snapshot {} of version {}".format(filename, snapshot.get("version")))
+            return False
+        region_states = {region: snapshot["region_states"].get(region, []) for region in REGIONS}
+        self.metadata = Metadata(snapshot["countries"], region_states)
+        return True
+
+    def save_snapshot(self, filename):
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "created": datetime.utcnow().isoformat(),
+            "countries": self.metadata.countries,
+            "region_states": self.metadata.region_states,
+        }
+        tmp_filename = filename + ".tmp"
+        try:
+            with open(tmp_filename, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_filename, filename)
+        except OSError:
+            logger.warning("Could not save the metadata snapshot {}".format(filename), exc_info=True)
+
+    # Loads the metadata snapshot and the time series store again if they changed, for processes that share
+    # the files with the one keeping them up to date.
+    def reload(self):
+        if self.snapshot_file:
+            try:
+                modified = os.path.getmtime(self.snapshot_file)
+            except OSError:
+                modified = None
+            if modified != self._snapshot_modified and self.load_snapshot(self.snapshot_file):
+                self._snapshot_modified = modified
+        store = self._timeseries_store()
+        if store is not None and store.reload():
+            self.update_analytics()
+
+    # refreshes the metadata in a daemon thread, right away and then every `interval` seconds
+    def start_refresh(self, interval=3600, retry_interval=60):
+        def run():
+            while True:
+                try:
+                    success = self.refresh_metadata()
+                except Exception:
+                    logger.exception("Refreshing the metadata failed")
+                    success = False
+                time.sleep(interval if success else retry_interval)
+        threading.Thread(target=run, name="metadata-refresh", daemon=True).start()
+
+    def _clean(self, s):
+        s = s.replace("\xad", "")
+        s = s.replace("\n", "")
+        return s
+
+    def _ttl(self, path):
+        prefix = max((p for p in self.ttls if path.startswith(p)), key=len)
+        return self.ttls[prefix]
+
+    def _fetch(self, path, params=None):
+        return self.client.get_json(BASE_URL + path, params=params, conditional=path in CONDITIONAL_PATHS)
+
+    def _key(self, path, params=None):
+        return (path, tuple(sorted(params.items())) if params else ())
+
+    # Returns the parsed JSON response of an endpoint or None. Responses are shared between callers, so
+    # they must not be modified.
+    def _get(self, path, params=None):
+        key = self._key(path, params)
+        data = self.cache.get(key, lambda: self._load(key, path, params), self._ttl(path))
+        if data is None:
+            # the API is down, so answer with the last good response
+            with self._last_good_lock:
+                entry = self._last_good.get(key)
+            return entry[0] if entry else None
+        return data
+
+    def _load(self, key, path, params):
+        missed = getattr(self._local, "missed", None)
+        if missed is not None:
+            missed.append((path, params))
+            return None
+        return self._remember(key, self.flights.do(key, lambda: self._fetch(path, params)))
+
+    # Calls a method of the API without fetching anything, endpoints that are not cached are answered with the
+    # last good response or None. Returns the result and the (path, params) of the endpoints that were missing,
+    # so the caller can load them, e.g. without blocking as AsyncCovidApi does, and call the method again.
+    def cached(self, method, *args, **kwargs):
+        self._local.missed = []
+        try:
+            return method(*args, **kwargs), self._local.missed
+        finally:
+            self._local.missed = None
+
+    # stores a response that was fetched by the caller in the cache, like the responses fetched by the API
+    def put(self, path, params, data):
+        key = self._key(path, params)
+        data = self._remember(key, data)
+        if data is not None:
+            self.cache.put(key, data, self._ttl(path))
+        return data
+
+    def _remember(self, key, data):
+        if data is not None:
+            now = time.time()
+            with self._last_good_lock:
+                self._last_good[key] = (data, now)
+                self._last_good.move_to_end(key)
+                while len(self._last_good) > self.last_good_size:
+                    self._last_good.popitem(last=False)
+                self.last_success = now
+        return data
+
+    # The time of the last successful response as datetime if the API is down, the data shown to users is from
+    # then. None if the API is available.
+    def data_as_of(self):
+        if self.client.breaker(BASE_URL).is_open and self.last_success:
+            return datetime.utcfromtimestamp(self.last_success)
+        return None
+
+    def load_last_good(self, filename):
+        if not os.path.exists(filename):
+            return False
+        try:
+            with open(filename, "r") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            logger.warning("Could not load the last good responses from {}".format(filename))
+            return False
+        with self._last_good_lock:
+            for path, params, fetched, data in snapshot["responses"]:
+                self._last_good[(path, tuple(tuple(param) for param in params))] = (data, fetched)
+                self.last_success = max(self.last_success or 0, fetched)
+        return True
+
+    def save_last_good(self, filename=None):
+        filename = filename or self.last_good_file
+        with self._last_good_lock:
+            responses = [[path, params, fetched, data] for (path, params), (data, fetched) in self._last_good.items()
+                         if path in LAST_GOOD_PATHS]
+        tmp_filename = filename + ".tmp"
+        try:
+            with open(tmp_filename, "w") as f:
+                json.dump({"responses": responses}, f)
+            os.replace(tmp_filename, filename)
+        except OSError:
+            logger.warning("Could not save the last good responses to {}".format(filename), exc_info=True)
+
     def _all_countries(self):
-        response = requests.get(BASE_URL + "countries")
-        if response.status_code == 200:
+        data = self._get("countries")
+        if data is not None:
             countries = {}
-            for item in response.json():
+            for item in data:
                 iso2 = item["countryInfo"]["iso2"]
                 if iso2:
-                    countries[iso2] = item["countryInfo"]
-                    countries[iso2]["name"] = item["country"]
+                    countries[iso2] = dict(item["countryInfo"], name=item["country"])
             return countries
         else:
             return {}
 
-    def _all_us_states(self):
-        response = requests.get(BASE_URL + "states")
-        if response.status_code == 200:
-            countries = []
-            for item in response.json():
-                countries.append(item["state"])
-            return countries
-        else:
-            return []
+    def _region_snapshot(self, region):
+        path, field = REGIONS[region]
+        data = self._get(path)
+        snapshot = self._regions.get(region)
+        # the snapshot is rebuilt whenever the cache has a new payload
+        if snapshot and (data is None or data is snapshot[0]):
+            return snapshot
+        states, names = {}, []
+        for item in data or []:
+            name = self._clean(item[field])
+            if name.lower() == "total":
+                continue
+            item = dict(item)
+            if "recovered" not in item and "active" in item:
+                # additions to unify format with countries
+                item["recovered"] = item["cases"] - item["active"] - item["deaths"]
+            states[name.lower()] = item
+            names.append(name)
+        snapshot = (data, states, names)
+        if data is not None:
+            self._regions[region] = snapshot
+        return snapshot
 
-    def _all_de_states(self):
-        response = requests.get(BASE_URL + "gov/de")
-        if response.status_code == 200:
-            countries = []
-            for item in response.json():
-                if item["province"].lower() != "total":
-                    countries.append(self._clean(item["province"]))
-            return countries
-        else:
-            return []
+    # returns the region of a state name or None
+    def find_region(self, state):
+        state = self._clean(state).lower()
+        for region in REGIONS:
+            if state in self._region_snapshot(region)[1]:
+                return region
+        return None
+
+    def cases_region(self, region, state):
+        return self._region_snapshot(region)[1].get(self._clean(state).lower())
 
     def cases_world(self, include_vaccinations=True):
-        response = requests.get(BASE_URL + "all")
-        if response.status_code == 200:
-            data = response.json()
+        data = self._get("all")
+        if data is not None:
+            data = dict(data)
             if include_vaccinations:
                 vacc = self.vaccinations_world()
                 data["vaccinations"] = vacc["vaccinations"] if vacc else math.nan
@@ -75,17 +358,51 @@ class CovidApi:
             return None
 
     def cases_country_list(self, sort_by="cases"):
-        response = requests.get(BASE_URL + "countries", params={"sort": sort_by})
-        if response.status_code == 200:
-            return [item for item in response.json() if item["countryInfo"]["iso2"]]
-        else:
-            return []
+        ranking = self.country_ranking()
+        return ranking.page(sort_by, 0, len(ranking))
+
+    # The joined table of cases, vaccinations and trend metrics of all countries, ranked by the given orders. It
+    # is rebuilt whenever the cache has new payloads or the metrics were updated.
+    def country_ranking(self, orders=()):
+        cases = self._get("countries")
+        vaccinations = self._get("vaccine/coverage/countries", params={"lastdays": 2})
+        analytics = self.analytics
+        if self._ranking and all(a is b for a, b in zip(self._ranking, (cases, vaccinations, analytics))):
+            return self._ranking[3]
+        rows = {}
+        for item in cases or []:
+            iso2 = item["countryInfo"]["iso2"]
+            if iso2:
+                rows[iso2] = dict(item, **analytics.get(iso2, {}))
+        for item in self._parse_vaccinations(vaccinations or []):
+            if item["countryInfo"]["iso2"] in rows:
+                row = rows[item["countryInfo"]["iso2"]]
+                row["vaccinations"] = item["vaccinations"]
+                row["todayVaccinations"] = item["todayVaccinations"]
+        ranking = RankingTable(list(rows.values()), orders)
+        if cases is not None:
+            self._ranking = (cases, vaccinations, analytics, ranking)
+        return ranking
 
     def cases_country(self, country, include_vaccinations=True):
-        country_code = self.name_map[country.lower()]
-        response = requests.get(BASE_URL + "countries/{}".format(country_code))
-        if response.status_code == 200:
-            data = response.json()
+        country_code = self.name_map.get(country.lower())
+        if country_code is None:
+            return None
+        # served from the joined table of the bulk endpoints, which the prefetcher keeps up to date
+        row = self.country_ranking().get(country_code)
+        if row is not None:
+            data = dict(row)
+            del data["countryInfo"]
+            if not include_vaccinations:
+                data.pop("vaccinations", None)
+                data.pop("todayVaccinations", None)
+            elif "vaccinations" not in data:
+                vacc = self.vaccinations_country(country)
+                data["vaccinations"] = vacc["vaccinations"] if vacc else math.nan
+            return data
+        data = self._get("countries/{}".format(country_code))
+        if data is not None:
+            data = dict(data)
             del data["countryInfo"]
             if include_vaccinations:
                 vacc = self.vaccinations_country(country)
@@ -95,33 +412,137 @@ class CovidApi:
             return None
 
     def cases_us_state(self, state):
-        response = requests.get(BASE_URL + "states/{}".format(state))
-        if response.status_code == 200:
-            data = response.json()
-            # additions to unify format with countries
-            data["recovered"] = data["cases"] - data["active"] - data["deaths"]
-            return data
-        else:
-            return None
+        return self.cases_region("us", state)
 
     def cases_de_state(self, state):
-        response = requests.get(BASE_URL + "gov/de")
-        if response.status_code == 200:
-            data = response.json()
-            filtered = [item for item in data if self._clean(item["province"].lower()) == state.lower()]
-            return filtered[0] if len(filtered) > 0 else None
-        else:
+        return self.cases_region("de", state)
+
+    def _timeseries_store(self):
+        if self._store is None and self.timeseries_dir:
+            # numpy is only imported once the store is used
+            from timeseries_store import TimeseriesStore
+            self._store = TimeseriesStore(self.timeseries_dir)
+        return self._store
+
+    # The days to fetch of a series: all the first time and then only the days since the last update.
+    def _timeseries_lastdays(self, store, name):
+        last_date = store.last_date(name)
+        return (datetime.utcnow().date() - last_date).days + 2 if last_date else "all"
+
+    # Fetches the timelines of a bulk endpoint since the last update. If it has countries the store has no numbers
+    # of yet, e.g. because they were only added to the name map, all days are fetched again.
+    def _fetch_timelines(self, store, name, path, timeline):
+        lastdays = self._timeseries_lastdays(store, name)
+        data = self._fetch(path, params={"lastdays": lastdays})
+        if data is not None and lastdays != "all":
+            codes = {self.name_map.get(item["country"].lower()) for item in data if timeline(item)}
+            if any(code is not None and not store.has(code, name) for code in codes):
+                data = self._fetch(path, params={"lastdays": "all"})
+        return data
+
+    # Fetches the timelines of all countries from the bulk endpoints into the time series store, all days
+    # the first time and then only the days since the last update.
+    def update_timeseries(self):
+        # the timelines of the countries are stored by their codes, so they need the metadata
+        if not self.name_map:
+            return False
+        store = self._timeseries_store()
+        timelines = {}
+        data = self._fetch_timelines(store, "cases", "historical", lambda item: item["timeline"]["cases"])
+        world = self._fetch("historical/all", params={"lastdays": self._timeseries_lastdays(store, "cases")})
+        if data is not None and world is not None:
+            cases, deaths = {"world": world["cases"]}, {"world": world["deaths"]}
+            for item in data:
+                code = self.name_map.get(item["country"].lower())
+                if code is None:
+                    continue
+                # the numbers of some countries are split into provinces
+                for totals, timeline in ((cases, item["timeline"]["cases"]), (deaths, item["timeline"]["deaths"])):
+                    total = totals.setdefault(code, {})
+                    for day, value in timeline.items():
+                        total[day] = total.get(day, 0) + value
+            timelines["cases"], timelines["deaths"] = cases, deaths
+        data = self._fetch_timelines(store, "vaccinations", "vaccine/coverage/countries", lambda item: item["timeline"])
+        world = self._fetch("vaccine/coverage", params={"lastdays": self._timeseries_lastdays(store, "vaccinations")})
+        if data is not None and world is not None:
+            vaccinations = {"world": world}
+            for item in data:
+                code = self.name_map.get(item["country"].lower())
+                if code is not None:
+                    vaccinations[code] = item["timeline"]
+            timelines["vaccinations"] = vaccinations
+        if timelines:
+            store.update(timelines)
+            self.update_analytics()
+        return bool(timelines)
+
+    # Fetches an endpoint, bypassing the cache, and stores the response in the cache. Returns the response or
+    # None if the request failed.
+    def prefetch(self, path, params=None):
+        key = self._key(path, params)
+        return self.put(path, params, self.flights.do(key, lambda: self._fetch(path, params)))
+
+    # rebuilds the tables derived from the bulk endpoints, so the next requests do not have to
+    def warm(self, orders=()):
+        ranking = self.country_ranking(orders)
+        for order in orders:
+            ranking.count(order)
+        for region in REGIONS:
+            self._region_snapshot(region)
+
+    # computes the trend metrics of all countries from the time series store
+    def update_analytics(self):
+        store = self._timeseries_store()
+        if store is None:
+            return
+        # numpy is only imported once the store is used
+        import analytics
+        populations = {}
+        for item in self._get("countries") or []:
+            if item["countryInfo"]["iso2"]:
+                populations[item["countryInfo"]["iso2"]] = item.get("population")
+        world = self._get("all")
+        if world:
+            populations["world"] = world.get("population")
+        self.analytics = analytics.compute(store, populations)
+
+    # the trend metrics of a country or of the world, e.g. "casesAvg7" and "casesGrowth"
+    def metrics(self, country=None):
+        key = self.name_map.get(country.lower()) if country else "world"
+        return self.analytics.get(key, {})
+
+    # the daily numbers of the last `days` days from the store, or None if it has no numbers of the country
+    def _stored_series(self, country, names, days):
+        store = self._timeseries_store()
+        key = self.name_map.get(country.lower()) if country else "world"
+        if store is None or key is None:
+            return None
+        series = [store.daily(key, name, days) for name in names]
+        if None in series:
             return None
+        data = {
+            "name": self.countries[key]["name"] if country else "the World",
+            "last_date": datetime.combine(series[0][0], datetime.min.time()),
+            "total": series[0][2],
+        }
+        for name, (_, daily, _) in zip(names, series):
+            data[name] = daily
+        return data
 
     def timeseries(self, country=None, days=36):
+        data = self._stored_series(country, ("cases", "deaths"), days)
+        if data is not None:
+            del data["total"]
+            return data
         # we always request one additional day to be able to calculate diffs
         if not country:
-            response = requests.get(BASE_URL + "historical/all", params={"lastdays": days + 1})
+            data = self._get("historical/all", params={"lastdays": days + 1})
         else:
-            country_code = self.name_map[country.lower()]
-            response = requests.get(BASE_URL + "historical/{}".format(country_code), params={"lastdays": days + 1})
-        if response.status_code == 200:
-            data = response.json()
+            country_code = self.name_map.get(country.lower())
+            if country_code is None:
+                return None
+            data = self._get("historical/{}".format(country_code), params={"lastdays": days + 1})
+        if data is not None:
             if "timeline" in data:  # if for a specific country
                 name = data["country"]
                 data = data["timeline"]
@@ -143,9 +564,8 @@ class CovidApi:
             return None
 
     def vaccinations_world(self):
-        response = requests.get(BASE_URL + "vaccine/coverage", params={"lastdays": 1})
-        if response.status_code == 200:
-            data = response.json()
+        data = self._get("vaccine/coverage", params={"lastdays": 1})
+        if data is not None:
             return {
                 "vaccinations": list(data.values())[0]
             }
@@ -153,10 +573,11 @@ class CovidApi:
             return None
 
     def vaccinations_country(self, country):
-        country_code = self.name_map[country.lower()]
-        response = requests.get(BASE_URL + "vaccine/coverage/countries/{}".format(country_code), params={"lastdays": 1})
-        if response.status_code == 200:
-            data = response.json()
+        country_code = self.name_map.get(country.lower())
+        if country_code is None:
+            return None
+        data = self._get("vaccine/coverage/countries/{}".format(country_code), params={"lastdays": 1})
+        if data is not None:
             return {
                 "country": data["country"],
                 "vaccinations": list(data["timeline"].values())[0]
@@ -164,36 +585,42 @@ class CovidApi:
         else:
             return None
 
+    def _parse_vaccinations(self, data):
+        country_list = []
+        for item in data:
+            # try to mimic the output format of cases list
+            if item["country"].lower() in self.name_map:
+                values = sorted(item["timeline"].items(), key=lambda s: datetime.strptime(s[0], "%m/%d/%y"))
+                vaccinations = values[1][1]
+                todayVaccinations = values[1][1] - values[0][1]
+                country_list.append({
+                    "country": item["country"],
+                    "vaccinations": vaccinations,
+                    "todayVaccinations": todayVaccinations,
+                    "countryInfo": {"iso2": self.name_map[item["country"].lower()]}
+                })
+        return country_list
+
     def vaccinations_country_list(self, sort_by="vaccinations"):
-        response = requests.get(BASE_URL + "vaccine/coverage/countries", params={"lastdays": 2})
-        if response.status_code == 200:
-            country_list = []
-            for item in response.json():
-                # try to mimic the output format of cases list
-                if item["country"].lower() in self.name_map:
-                    values = sorted(item["timeline"].items(), key=lambda s: datetime.strptime(s[0], "%m/%d/%y"))
-                    vaccinations = values[1][1]
-                    todayVaccinations = values[1][1] - values[0][1]
-                    data = {
-                        "country": item["country"],
-                        "vaccinations": vaccinations,
-                        "todayVaccinations": todayVaccinations,
-                        "countryInfo": {"iso2": self.name_map[item["country"].lower()]}
-                    }
-                    country_list.append(data)
-            return sorted(country_list, key=lambda c: c[sort_by], reverse=True)
+        data = self._get("vaccine/coverage/countries", params={"lastdays": 2})
+        if data is not None:
+            return sorted(self._parse_vaccinations(data), key=lambda c: c[sort_by], reverse=True)
         else:
             return []
 
     def vaccinations_series(self, country=None, days=36):
+        data = self._stored_series(country, ("vaccinations",), days)
+        if data is not None:
+            return data
         # we always request one additional day to be able to calculate diffs
         if not country:
-            response = requests.get(BASE_URL + "vaccine/coverage", params={"lastdays": days + 1})
+            data = self._get("vaccine/coverage", params={"lastdays": days + 1})
         else:
-            country_code = self.name_map[country.lower()]
-            response = requests.get(BASE_URL + "vaccine/coverage/countries/{}".format(country_code), params={"lastdays": days + 1})
-        if response.status_code == 200:
-            data = response.json()
+            country_code = self.name_map.get(country.lower())
+            if country_code is None:
+                return None
+            data = self._get("vaccine/coverage/countries/{}".format(country_code), params={"lastdays": days + 1})
+        if data is not None:
             if "timeline" in data:  # if for a specific country
                 name = data["country"]
                 data = data["timeline"]
@@ -0,0 +1,119 @@
+from collections import defaultdict
+from datetime import time, timedelta
+import threading
+
+# the notification times are rounded down to slots of this many minutes, every slot is sent in its own wave
+SLOT_MINUTES = 15
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+
+
+def slot_of(t):
+    return (t.hour * 60 + t.minute) // SLOT_MINUTES
+
+
+def slot_time(slot):
+    return time(hour=slot * SLOT_MINUTES // 60, minute=slot * SLOT_MINUTES % 60)
+
+
+# the start of the next slot after `now`, when the job running the waves is first due
+def next_slot_start(now):
+    start = now.replace(minute=now.minute - now.minute % SLOT_MINUTES, second=0, microsecond=0)
+    return start + timedelta(minutes=SLOT_MINUTES)
+
+
+# Subscribers used to be a list of chat ids, they are converted to {chat_id: (lang, slot)}. A language or slot of
+# None means English and the default notification time.
+def normalize(subscribers):
+    if isinstance(subscribers, dict):
+        return subscribers
+    return {chat_id: (None, None) for chat_id in subscribers}
+
+
+class SubscriberRegistry:
+    """The chats subscribed to the daily notifications, with their language and notification time slot.
+
+    The subscribers are kept in bot_data, so every persistence saves them. 'subscribers_version' is incremented on
+    every change, so a persistence can tell whether the subscribers changed without comparing them. The chats of
+    every slot are indexed in memory.
+
+    Chats are unsubscribed by the threads of the broadcaster, while the dispatcher threads save bot_data. So the
+    dict of the subscribers is replaced on every change instead of being modified while it is saved.
+    """
+
+    def __init__(self, default_slot=None):
+        self.default_slot = default_slot
+        self.bot_data = {}
+        self._lock = threading.Lock()
+        self._slots = defaultdict(set)
+
+    # uses the subscribers in the bot_data of the dispatcher, once the persistence loaded it
+    def load(self, bot_data):
+        with self._lock:
+            self.bot_data = bot_data
+            subscribers = bot_data.get('subscribers', {})
+            bot_data['subscribers'] = normalize(subscribers)
+            bot_data.setdefault('subscribers_version', 0)
+            if not isinstance(subscribers, dict):
+                self._changed()
+            self._slots = defaultdict(set)
+            for chat_id, (_, slot) in self.subscribers.items():
+                self._slots[self._slot(slot)].add(chat_id)
+
+    @property
+    def subscribers(self):
+        return self.bot_data.get('subscribers', {})
+
+    def _slot(self, slot):
+        return self.default_slot if slot is None else slot
+
+    def _changed(self):
+        self.bot_data['subscribers_version'] = self.bot_data.get('subscribers_version', 0) + 1
+
+    def __contains__(self, chat_id):
+        return chat_id in self.subscribers
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    # the language and slot of a chat, a slot of None keeps the current one or uses the default notification time
+    def subscribe(self, chat_id, lang, slot=None):
+        with self._lock:
+            old = self.subscribers.get(chat_id)
+            if slot is None and old is not None:
+                slot = old[1]
+            if old == (lang, slot):
+                return
+            if old is not None:
+                self._slots[self._slot(old[1])].discard(chat_id)
+            subscribers = dict(self.subscribers)
+            subscribers[chat_id] = (lang, slot)
+            self.bot_data['subscribers'] = subscribers
+            self._slots[self._slot(slot)].add(chat_id)
+            self._changed()
+
+    def unsubscribe(self, chat_id):
+        with self._lock:
+            old = self.subscribers.get(chat_id)
+            if old is None:
+                return False
+            subscribers = dict(self.subscribers)
+            del subscribers[chat_id]
+            self.bot_data['subscribers'] = subscribers
+            self._slots[self._slot(old[1])].discard(chat_id)
+            self._changed()
+            return True
+
+    # the notification time of a chat, or None if it is not subscribed
+    def notify_time(self, chat_id):
+        entry = self.subscribers.get(chat_id)
+        if entry is None:
+            return None
+        slot = self._slot(entry[1])
+        return slot_time(slot) if slot is not None else None
+
+    # [(chat_id, lang)] of the chats to notify in a slot
+    def in_slot(self, slot):
+        with self._lock:
+            chat_ids = list(self._slots.get(slot, ()))
+        subscribers = self.subscribers
+        return [(chat_id, subscribers[chat_id][0]) for chat_id in chat_ids if chat_id in subscribers]
@@ -0,0 +1,43 @@
+import tempfile
+import unittest
+
+from media_cache import ImageCache
+
+
+class ImageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_evicted_images_are_spilled(self):
+        cache = ImageCache(max_memory=2, directory=self.directory.name)
+        cache.put("a", b"a")
+        cache.put("b", b"b")
+        cache.put("c", b"c")
+        self.assertEqual(cache.memory_size, 2)
+        self.assertEqual(cache.get("a"), b"a")
+        # promoting a from disk evicted b, which was only in memory
+        self.assertEqual(cache.get("b"), b"b")
+        self.assertEqual(cache.get("c"), b"c")
+
+    def test_without_directory(self):
+        cache = ImageCache(max_memory=2)
+        cache.put("a", b"a")
+        cache.put("b", b"b")
+        cache.put("c", b"c")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("c"), b"c")
+
+    def test_write_through(self):
+        cache = ImageCache(directory=self.directory.name, write_through=True)
+        cache.put("a", b"a")
+        cache.clear()
+        self.assertEqual(cache.get("a"), b"a")
+        self.assertEqual(ImageCache(directory=self.directory.name).get("a"), b"a")
+
+
+if __name__ == "__main__":
+    unittest.main()
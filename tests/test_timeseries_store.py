@@ -0,0 +1,63 @@
+from datetime import date, timedelta
+import tempfile
+import unittest
+
+from timeseries_store import TimeseriesStore
+
+
+def _timeline(first_date, values):
+    return {(first_date + timedelta(days=i)).strftime("%m/%d/%y"): value for i, value in enumerate(values)}
+
+
+class TimeseriesStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = TimeseriesStore(self.directory.name)
+        self.first_date = date(2021, 3, 1)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_daily(self):
+        self.store.update({"cases": {"world": _timeline(self.first_date, [1, 3, 6, 10])}})
+        self.assertEqual(self.store.daily("world", "cases", 3), (date(2021, 3, 4), [2, 3, 4], 10))
+        # the store has fewer days, but all of them from the first day of the place
+        self.assertEqual(self.store.daily("world", "cases", 10), (date(2021, 3, 4), [2, 3, 4], 10))
+        self.assertIsNone(self.store.daily("KE", "cases", 3))
+        self.assertIsNone(self.store.daily("world", "deaths", 3))
+
+    def test_missing_days_repeat_the_day_before(self):
+        self.store.update({"cases": {"world": _timeline(self.first_date, [1, None, 6, 10])}})
+        self.assertEqual(self.store.daily("world", "cases", 3)[1], [0, 5, 4])
+
+    def test_days_before_the_first_number(self):
+        self.store.update({"vaccinations": {
+            "world": _timeline(self.first_date, [1, 2, 3, 4, 5, 6]),
+            "KE": _timeline(self.first_date + timedelta(days=3), [100, 150, 200]),
+        }})
+        self.assertEqual(self.store.daily("KE", "vaccinations", 2)[1], [50, 50])
+        # the first number is the total of all days before it, not a daily number
+        self.assertIsNone(self.store.daily("KE", "vaccinations", 3))
+        self.assertIsNone(self.store.daily("KE", "vaccinations", 5))
+
+    def test_row_added_by_incremental_update(self):
+        self.store.update({"cases": {"world": _timeline(self.first_date, list(range(1, 41)))}})
+        self.assertFalse(self.store.has("KE", "cases"))
+        last_days = self.first_date + timedelta(days=38)
+        self.store.update({"cases": {"world": _timeline(last_days, [39, 40]), "KE": _timeline(last_days, [5, 10])}})
+        self.assertTrue(self.store.has("KE", "cases"))
+        self.assertEqual(self.store.daily("KE", "cases", 1)[1], [5])
+        self.assertIsNone(self.store.daily("KE", "cases", 36))
+        self.assertEqual(len(self.store.daily("world", "cases", 36)[1]), 36)
+
+    def test_reload(self):
+        self.store.update({"cases": {"world": _timeline(self.first_date, [1, 2])}})
+        other = TimeseriesStore(self.directory.name)
+        self.store.update({"cases": {"world": _timeline(self.first_date + timedelta(days=2), [4])}})
+        self.assertTrue(other.reload())
+        self.assertEqual(other.daily("world", "cases", 2)[1], [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+from datetime import date, datetime, timedelta
+import glob
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# the format of the index file, stores of other versions are ignored and filled again
+STORE_VERSION = 1
+
+
+def _parse_dates(strings):
+    parsed = {}
+    for s in strings:
+        if s not in parsed:
+            parsed[s] = datetime.strptime(s, "%m/%d/%y").date()
+    return parsed
+
+
+# replaces every missing value with the last value before it, leading missing values are kept
+def _forward_fill(array):
+    missing = np.isnan(array)
+    if not missing.any():
+        return array
+    index = np.where(missing, 0, np.arange(array.shape[1]))
+    np.maximum.accumulate(index, axis=1, out=index)
+    return array[np.arange(array.shape[0])[:, None], index]
+
+
+class TimeseriesStore:
+    """The cumulative daily numbers of the world and of every country in NumPy arrays.
+
+    Every series, e.g. "cases", is a 2d array with one row per place and one column per day, which is saved as
+    .npy file and memory-mapped when it is loaded. index.json lists the row keys and the first date of every
+    series. `update` merges new timelines and replaces the files atomically, readers keep the arrays they got.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        # (row keys, {series: (first date, array)}), swapped as a whole
+        self._state = ({}, {})
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        if not os.path.exists(self._path("index.json")):
+            return
+        try:
+            with open(self._path("index.json"), "r") as f:
+                index = json.load(f)
+            if index.get("version") != STORE_VERSION:
+                return
+            series = {}
+            for name, first_date in index["series"].items():
+                array = np.load(self._path("{}.{}.npy".format(name, index["generation"])), mmap_mode="r")
+                series[name] = (date.fromisoformat(first_date), array)
+        except (OSError, ValueError, KeyError):
+            logger.warning("Could not load the time series store in {}".format(self.directory))
+            return
+        self._generation = index["generation"]
+        self._state = ({key: row for row, key in enumerate(index["keys"])}, series)
+
+    # loads the files again if another process updated the store, returns whether it changed
+    def reload(self):
+        try:
+            with open(self._path("index.json"), "r") as f:
+                generation = json.load(f).get("generation")
+        except (OSError, ValueError):
+            return False
+        with self._lock:
+            if generation == self._generation:
+                return False
+            self._load()
+        return True
+
+    def last_date(self, name):
+        series = self._state[1].get(name)
+        if series is None:
+            return None
+        first_date, array = series
+        return first_date + timedelta(days=array.shape[1] - 1)
+
+    # the keys of the rows, the last date and the array of a series, or None if the store does not have it
+    def series(self, name):
+        rows, series = self._state
+        if name not in series:
+            return None
+        first_date, array = series[name]
+        keys = sorted(rows, key=rows.get)[:array.shape[0]]
+        return keys, first_date + timedelta(days=array.shape[1] - 1), array
+
+    # whether the store has any numbers of a place in a series
+    def has(self, key, name):
+        rows, series = self._state
+        if key not in rows or name not in series:
+            return False
+        array = series[name][1]
+        return rows[key] < array.shape[0] and not np.isnan(array[rows[key]]).all()
+
+    # Returns the last date, the daily differences of the last `days` days and the latest cumulative number of
+    # a place, or None if the store does not have the numbers of all these days.
+    def daily(self, key, name, days):
+        rows, series = self._state
+        if key not in rows or name not in series:
+            return None
+        first_date, array = series[name]
+        row = rows[key]
+        if row >= array.shape[0] or array.shape[1] == 0:
+            return None
+        values = array[row]
+        # one additional day to calculate the first difference
+        start = len(values) - days - 1
+        # Missing days are filled with the day before when the store is updated, so only the days before the first
+        # number of the place are missing. Their differences are unknown, the first number is the whole total.
+        missing = np.isnan(values)
+        if missing[-1] or (missing[0] and np.argmin(missing) > max(0, start)):
+            return None
+        daily = np.diff(values[max(0, start):]).astype(np.int64)
+        return first_date + timedelta(days=array.shape[1] - 1), daily.tolist(), int(values[-1])
+
+    # Merges timelines into the store, `timelines` maps a series name to {key: {"m/d/yy": number}}.
+    def update(self, timelines):
+        with self._lock:
+            rows, series = self._state
+            keys = list(rows)
+            rows = dict(rows)
+            for by_key in timelines.values():
+                for key in by_key:
+                    if key not in rows:
+                        rows[key] = len(keys)
+                        keys.append(key)
+            series = dict(series)
+            for name, by_key in timelines.items():
+                dates = _parse_dates(s for timeline in by_key.values() for s in timeline)
+                if not dates:
+                    continue
+                first_date, end_date = min(dates.values()), max(dates.values())
+                old = series.get(name)
+                if old is not None:
+                    old_end = old[0] + timedelta(days=old[1].shape[1] - 1)
+                    first_date, end_date = min(first_date, old[0]), max(end_date, old_end)
+                array = np.full((len(keys), (end_date - first_date).days + 1), np.nan)
+                if old is not None:
+                    offset = (old[0] - first_date).days
+                    array[:old[1].shape[0], offset:offset + old[1].shape[1]] = old[1]
+                for key, timeline in by_key.items():
+                    row = rows[key]
+                    for s, value in timeline.items():
+                        if value is not None:
+                            array[row, (dates[s] - first_date).days] = value
+                series[name] = (first_date, _forward_fill(array))
+            self._save(keys, series)
+
+    def _save(self, keys, series):
+        os.makedirs(self.directory, exist_ok=True)
+        generation = self._generation + 1
+        for name, (_, array) in series.items():
+            tmp_filename = self._path("{}.{}.npy.tmp".format(name, generation))
+            with open(tmp_filename, "wb") as f:
+                np.save(f, np.asarray(array))
+            os.replace(tmp_filename, self._path("{}.{}.npy".format(name, generation)))
+        # the new generation is only used once the index points to it
+        index = {
+            "version": STORE_VERSION,
+            "generation": generation,
+            "keys": keys,
+            "series": {name: first_date.isoformat() for name, (first_date, _) in series.items()},
+        }
+        tmp_filename = self._path("index.json.tmp")
+        with open(tmp_filename, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_filename, self._path("index.json"))
+        self._load()
+        for filename in glob.glob(self._path("*.npy")):
+            if not filename.endswith(".{}.npy".format(generation)):
+                os.remove(filename)
@@ -0,0 +1,166 @@
+from collections import OrderedDict
+import logging
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (3.05, 10)
+
+user_agent = "coronapandemicbot Python/{}.{}".format(sys.version_info[0], sys.version_info[1])
+
+
+class CircuitBreaker:
+    """Fails fast after `threshold` consecutive failures of a host, instead of waiting for every request to time out.
+
+    After `reset_timeout` seconds, one trial request is let through. If it succeeds, the circuit is closed again,
+    otherwise it stays open for another `reset_timeout` seconds.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.rejected = 0
+        # monotonic time when the circuit was opened, None if it is closed
+        self.opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def allow(self):
+        with self._lock:
+            if self.opened is None:
+                return True
+            if not self._trial and time.monotonic() - self.opened >= self.reset_timeout:
+                self._trial = True
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.opened is not None:
+                logger.info("Circuit closed again after {} rejected requests.".format(self.rejected))
+            self.failures = 0
+            self.opened = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self.opened is None and self.failures >= self.threshold):
+                if self.opened is None:
+                    logger.warning("Circuit opened after {} failed requests.".format(self.failures))
+                self.opened = time.monotonic()
+            self._trial = False
+
+
+class HttpClient:
+    """A shared HTTP client with pooled keep-alive connections, timeouts and retries.
+
+    `get_json` can revalidate responses with ETag/If-Modified-Since, so that an unchanged payload is answered
+    with a cheap 304 and the previously parsed body is reused. Every host has a CircuitBreaker, so requests of
+    `get_json` fail right away while a host is down.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=2, backoff_factor=0.5, pool_size=16, max_validators=64,
+                 breaker_threshold=5, breaker_timeout=30):
+        self.timeout = timeout
+        self.max_validators = max_validators
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self._breakers = {}
+        self.not_modified = 0
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"User-Agent": user_agent, "Accept-Encoding": "gzip, deflate"})
+        # (url, params) -> (etag, last modified, parsed body)
+        self._validators = OrderedDict()
+        self._lock = threading.Lock()
+
+    def breaker(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.breaker_threshold, self.breaker_timeout)
+            return self._breakers[host]
+
+    def get(self, url, params=None, timeout=None, **kwargs):
+        return self.session.get(url, params=params, timeout=timeout or self.timeout, **kwargs)
+
+    def head(self, url, timeout=None, **kwargs):
+        return self.session.head(url, timeout=timeout or self.timeout, **kwargs)
+
+    # the validator of the last response of `key` and the headers to revalidate it with
+    def conditional_headers(self, key):
+        headers = {}
+        with self._lock:
+            validator = self._validators.get(key)
+        if validator:
+            etag, last_modified, _ = validator
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        return validator, headers
+
+    # Returns the parsed body of a response, or the body of the validator if it was not modified. `parse` is
+    # only called for a successful response.
+    def response_data(self, key, validator, status, headers, parse, conditional):
+        if status == 304 and validator:
+            self.not_modified += 1
+            with self._lock:
+                if key in self._validators:
+                    self._validators.move_to_end(key)
+            return validator[2]
+        if status != 200:
+            return None
+        data = parse()
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        if conditional and (etag or last_modified):
+            with self._lock:
+                self._validators[key] = (etag, last_modified, data)
+                self._validators.move_to_end(key)
+                while len(self._validators) > self.max_validators:
+                    self._validators.popitem(last=False)
+        return data
+
+    # Returns the parsed JSON body or None if the request failed.
+    def get_json(self, url, params=None, timeout=None, conditional=False):
+        key = (url, tuple(sorted(params.items())) if params else ())
+        validator, headers = self.conditional_headers(key) if conditional else (None, {})
+        breaker = self.breaker(url)
+        if not breaker.allow():
+            return None
+        try:
+            response = self.get(url, params=params, timeout=timeout, headers=headers)
+        except requests.RequestException as ex:
+            breaker.failure()
+            logger.warning("Request to {} failed: {}".format(url, ex))
+            return None
+        if response.status_code >= 500 or response.status_code == 429:
+            breaker.failure()
+        else:
+            breaker.success()
+        return self.response_data(key, validator, response.status_code, response.headers, response.json, conditional)
+
+client = HttpClient()
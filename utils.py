@@ -20,7 +20,9 @@ def handler_decorator(handler):
             context.user_data['count'] = 1
         else:
             context.user_data['count'] += 1
-        context.dispatcher.persistence.flush()
+        # a write-behind persistence saves the changes by itself
+        if not getattr(context.dispatcher.persistence, 'write_behind', False):
+            context.dispatcher.persistence.flush()
         return ret
     return wrapper
 
@@ -0,0 +1,126 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from urllib.parse import urlsplit
+
+from telegram import Bot, Update
+
+logger = logging.getLogger(__name__)
+
+
+# The id of the chat an update belongs to, or of the user for updates without a chat, e.g. inline queries.
+# Updates without either, e.g. polls, use the update id.
+def chat_id(update):
+    for key, value in update.items():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat') or value.get('from') or value.get('user')
+        if chat:
+            return chat['id']
+    return update.get('update_id', 0)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        if self.path != server.url_path or (server.secret_token and
+                self.headers.get("X-Telegram-Bot-Api-Secret-Token") != server.secret_token):
+            self.send_error(403)
+            return
+        try:
+            update = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            self.send_error(400)
+            return
+        server.dispatch(update)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """Receives the updates Telegram posts to the webhook and passes them on to the worker processes.
+
+    Updates are assigned to the workers by chat id, so the updates of a chat are handled by one worker in the
+    order they arrived, and the data of the chat is only cached by that worker. The updates of a user can reach
+    several workers, so the persistence reads the user data again before every update. Telegram expects HTTPS, so
+    the server is meant to run behind a proxy terminating TLS.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, url_path, queues, secret_token=None):
+        super().__init__(address, _RequestHandler)
+        self.url_path = url_path
+        self.queues = queues
+        self.secret_token = secret_token
+
+    def dispatch(self, update):
+        self.queues[chat_id(update) % len(self.queues)].put(update)
+
+
+# runs in the worker processes, `setup` returns the updater of the bot and a function to call once it stopped
+def _work(setup, config, worker, updates):
+    # the server process stops the workers once it received the signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    updater, shutdown = setup(config, worker)
+    dispatcher = updater.dispatcher
+    thread = threading.Thread(target=dispatcher.start, name="dispatcher")
+    thread.start()
+    updater.job_queue.start()
+    logger.info("Webhook worker {} started.".format(worker))
+    while True:
+        update = updates.get()
+        if update is None:
+            break
+        dispatcher.update_queue.put(Update.de_json(update, updater.bot))
+    updater.job_queue.stop()
+    dispatcher.stop()
+    thread.join()
+    if dispatcher.persistence:
+        dispatcher.persistence.flush()
+    shutdown()
+
+
+def serve(config, setup):
+    """Runs the bot in webhook mode, with `webhook_workers` processes handling the updates.
+
+    `setup(config, worker)` is called in every worker process to create its updater. The workers are forked
+    before any threads are started. Several workers need the sqlite persistence, which all of them can share.
+    """
+    workers = config.get('webhook_workers', 1)
+    if workers > 1 and config.get('persistence') != "sqlite":
+        raise ValueError("Several webhook workers need the sqlite persistence")
+    context = multiprocessing.get_context("fork")
+    queues = [context.Queue() for _ in range(workers)]
+    processes = [context.Process(target=_work, args=(setup, config, worker, queue), name="worker-{}".format(worker))
+                 for worker, queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+    url = config['webhook_url']
+    secret_token = config.get('webhook_secret')
+    # Heroku and similar platforms pass the port to listen on in $PORT
+    address = (config.get('webhook_listen', "0.0.0.0"), config.get('webhook_port', int(os.environ.get("PORT", 8443))))
+    server = WebhookServer(address, urlsplit(url).path or "/", queues, secret_token)
+    Bot(config['token']).set_webhook(url, secret_token=secret_token)
+    # shutdown waits for serve_forever to return, so it cannot be called by the handler in the same thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    logger.info("Listening for updates on {}:{} with {} workers.".format(address[0], address[1], workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join()
@@ -1,68 +1,206 @@
-from SPARQLWrapper import SPARQLWrapper, JSON
-import requests
+import hashlib
+import json
 import logging
-import sys
 from datetime import datetime
+import os
+import threading
+import time
+from urllib.parse import quote, unquote
 
-logger = logging.getLogger(__name__)
+import requests
 
-# set a custom user agent to reduce the chance of getting blocked
-user_agent = "coronapandemicbot Python/{}.{}".format(sys.version_info[0], sys.version_info[1])
-sparql = SPARQLWrapper("https://query.wikidata.org/sparql", agent=user_agent)
+import transport
+
+logger = logging.getLogger(__name__)
 
 WORLD_MAP="https://upload.wikimedia.org/wikipedia/commons/thumb/3/3b/COVID-19_Outbreak_World_Map_per_Capita.svg/500px-COVID-19_Outbreak_World_Map_per_Capita.svg.png"
 
-cached = {}
+# the map urls of all countries are stored here and resolved again after CACHE_TTL seconds
+CACHE_FILE="cache/maps.json"
+CACHE_TTL=7*24*3600
+# seconds until a failed query is tried again
+RETRY_INTERVAL=600
+
+SPARQL_URL="https://query.wikidata.org/sparql"
+# redirects to the current upload url of a file on Wikimedia Commons, even if the file was renamed
+FILE_PATH_URL="https://commons.wikimedia.org/wiki/Special:FilePath/"
+# the distribution map of the COVID-19 pandemic in every country, with its iso2 and iso3 codes
+QUERY = """
+    PREFIX pq: <http://www.wikidata.org/prop/qualifier/>
+    PREFIX p: <http://www.wikidata.org/prop/>
+    PREFIX wdt: <http://www.wikidata.org/prop/direct/>
+    PREFIX wd: <http://www.wikidata.org/entity/>
+    SELECT ?iso2 ?iso3 ?img
+    WHERE
+    {
+        ?page p:P31 ?prop.
+        ?prop pq:P642 wd:Q84263196.
+        ?page wdt:P276 ?country.
+        ?country wdt:P297 ?iso2.
+        ?country wdt:P298 ?iso3.
+        ?page wdt:P1846 ?img.
+    }"""
+
+# {"fetched": timestamp, "maps": {country code: map url}}, countries without a map are not listed
+cached = None
+# the earliest time to query Wikidata again
+next_query = 0
+# whether a query is running, the other callers are answered with the outdated urls meanwhile
+querying = False
+# the upload urls that were found to exist since the maps were last resolved, see _check_url
+checked = set()
+lock = threading.Lock()
+resolved = threading.Condition(lock)
 
-# We cannot send an svg as picture in Telegram. So, for svgs, find a matching png.
-def _check_path(url):
-    r = requests.get(url)
-    path = r.url
-    if path.endswith(".svg"):
-        path = path.replace("/commons/", "/commons/thumb/")
-        file_name = path.split('/')[-1]
-        return path+"/500px-"+file_name+".png"
+# The image links are file paths of Wikimedia Commons, which redirect to upload.wikimedia.org. The upload url
+# only depends on the md5 hash of the file name, so it is computed here instead of following the redirects. We
+# cannot send an svg as picture in Telegram. So, for svgs, link to a png thumbnail.
+def _upload_url(url):
+    file_name = unquote(url.split('/')[-1]).replace(' ', '_')
+    digest = hashlib.md5(file_name.encode("utf-8")).hexdigest()
+    path = "{}/{}/{}".format(digest[0], digest[:2], quote(file_name))
+    if file_name.lower().endswith(".svg"):
+        return "https://upload.wikimedia.org/wikipedia/commons/thumb/{}/500px-{}.png".format(path, quote(file_name))
     else:
-        return path
+        return "https://upload.wikimedia.org/wikipedia/commons/{}".format(path)
+
+# the maps from the JSON results of QUERY
+def parse_maps(results):
+    maps = {}
+    for result in results['results']['bindings']:
+        url = _upload_url(result['img']['value'])
+        for code in (result['iso2']['value'], result['iso3']['value']):
+            maps.setdefault(code.upper(), url)
+    return maps
+
+# resolves the maps of all countries with one query
+def _query_maps():
+    # SPARQLWrapper takes long to import, so it is only loaded when the first map is requested
+    from SPARQLWrapper import SPARQLWrapper
+    # a new instance for every query, as SPARQLWrapper keeps the query in its state
+    # set a custom user agent to reduce the chance of getting blocked
+    sparql = SPARQLWrapper(SPARQL_URL, agent=transport.user_agent)
+    sparql.setTimeout(transport.DEFAULT_TIMEOUT[1])
+    sparql.setQuery(QUERY)
+    sparql.setReturnFormat("json")
+    return parse_maps(sparql.query().convert())
+
+def _load_cache():
+    try:
+        with open(CACHE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _save_cache(cache):
+    # the cache file may be shared by several processes, each of them writes its own temporary file
+    tmp_file = "{}.{}.tmp".format(CACHE_FILE, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE) or ".", exist_ok=True)
+        with open(tmp_file, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, CACHE_FILE)
+    except OSError as ex:
+        logger.warning("Could not save the map cache: {}".format(ex))
+
+# Whether the maps have to be resolved again, called with the lock held. If so, the query is marked as running
+# and the caller has to store its result with _resolved.
+def _due(now):
+    global cached, querying
+    if cached is None:
+        cached = _load_cache()
+    if (cached is None or now - cached['fetched'] > CACHE_TTL) and now >= next_query and not querying:
+        # another process may have resolved the maps in the meantime
+        cached = _load_cache() or cached
+        querying = cached is None or now - cached['fetched'] > CACHE_TTL
+        return querying
+    return False
+
+# stores the maps of a query, or None if it failed, called with the lock held
+def _resolved(now, maps):
+    global cached, next_query, querying
+    querying = False
+    resolved.notify_all()
+    if maps is None:
+        # keep the outdated urls, if any
+        next_query = now + RETRY_INTERVAL
+    else:
+        cached = {"fetched": now, "maps": maps}
+        checked.clear()
+        _save_cache(cached)
+
+# The map urls of all countries, from the cache file or resolved again if it is outdated. The lock is not held
+# during the query, so the other callers get the outdated urls instead of waiting for it.
+def _maps():
+    with lock:
+        now = time.time()
+        due = _due(now)
+        # without any urls, wait for the query of another thread
+        while not due and cached is None and querying:
+            resolved.wait()
+    if due:
+        maps = None
+        try:
+            maps = _query_maps()
+        except Exception as ex:
+            logger.info(ex)
+        with lock:
+            _resolved(now, maps)
+    return cached['maps'] if cached else {}
+
+# For callers that run QUERY by themselves, e.g. without blocking: whether the maps have to be resolved again. If
+# so, the caller has to store the maps of the query, or None if it failed, with set_maps.
+def query_due():
+    with lock:
+        return _due(time.time())
+
+def set_maps(maps):
+    with lock:
+        _resolved(time.time(), maps)
+
+# The upload url of a file that was renamed on Commons returns 404, only Special:FilePath follows the redirect
+# to the new name. So every url is checked once before it is served, and replaced if the file was renamed.
+def _check_url(url):
+    if url in checked:
+        return url
+    try:
+        response = transport.client.head(url)
+        if response.status_code == 404:
+            # the file name is the last part of the url, or the one before for thumbnails
+            parts = url.split('/')
+            file_name = unquote(parts[-2] if "/thumb/" in url else parts[-1])
+            response = transport.client.head(FILE_PATH_URL + quote(file_name), allow_redirects=True)
+            if response.status_code != 200:
+                logger.info("Map {} not found".format(file_name))
+                return url
+            new_url = _upload_url(response.url)
+            with lock:
+                if cached:
+                    for code, map_url in cached['maps'].items():
+                        if map_url == url:
+                            cached['maps'][code] = new_url
+                    _save_cache(cached)
+            url = new_url
+    except requests.RequestException as ex:
+        logger.info(ex)
+        return url
+    checked.add(url)
+    return url
 
 # add a timestamp parameter to every image link to avoid long caching by Telegram servers
 def _add_timestamp(url):
     timestamp = datetime.utcnow().strftime("%Y%m%d%H")
     return "{}?t={}".format(url, timestamp)
 
-def cases_world_map():
-    return _add_timestamp(WORLD_MAP)
-
-def cases_country_map(country_code):
-    country_code = country_code.upper()
-    if country_code in cached:
-        return _add_timestamp(cached[country_code])
-    sparql.setQuery("""
-        PREFIX pq: <http://www.wikidata.org/prop/qualifier/>
-        PREFIX p: <http://www.wikidata.org/prop/>
-        PREFIX wdt: <http://www.wikidata.org/prop/direct/>
-        PREFIX wd: <http://www.wikidata.org/entity/>
-        SELECT ?img
-        WHERE 
-        {{
-            ?page p:P31 ?prop.
-            ?prop pq:P642 wd:Q84263196.
-            ?page wdt:P276 ?country.
-            ?country wdt:P297 ?iso2.
-            ?country wdt:P298 ?iso3.
-            ?page wdt:P1846 ?img.
-            FILTER(?iso2 = "{0}" || ?iso3 = "{0}")
-        }}""".format(country_code))
-    sparql.setReturnFormat(JSON)
-    try:
-        results = sparql.query().convert()['results']['bindings']
-        logger.debug(results)
-        if len(results) > 0:
-            path = _check_path(results[0]['img']['value'])
-            cached[country_code] = path
-            return _add_timestamp(path)
-        else:
-            return None
-    except Exception as ex:
-        logger.info(ex)
-        return None
+# without the timestamp, the url of the image itself is returned, e.g. to download it
+def cases_world_map(timestamp=True):
+    return _add_timestamp(WORLD_MAP) if timestamp else WORLD_MAP
+
+# countries without a map are answered from the cache as well, until it is resolved again
+def cases_country_map(country_code, timestamp=True):
+    path = _maps().get(country_code.upper())
+    if path:
+        path = _check_url(path)
+    if path and timestamp:
+        return _add_timestamp(path)
+    return path